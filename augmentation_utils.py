@@ -0,0 +1,86 @@
+import math
+import tensorflow as tf
+
+## a coin flip for each example in a batch
+def _coin(images):
+    return tf.less(tf.random_uniform([tf.shape(images)[0]], 0, 1.0), 0.5)
+
+## apply an exact rearrangement of the pixels to the examples of a batch (and their labels if given) where coin is set
+def _apply_where(coin, rearrange, images, labels=None):
+    images = tf.where(coin, rearrange(images), images)
+
+    if labels is not None:
+        labels = tf.where(coin, rearrange(labels), labels)
+
+    return images, labels
+
+## Randomly flip each image in a batch along an axis, 1 for up down and 2 for left right. The coin is flipped per image
+## rather than once for the batch. The flip reverses the index so the pixels are moved exactly, and the labels are
+## flipped with their images if given.
+## Returns: the images and the labels, None if none were given
+def random_flip(images, axis, labels=None):
+    return _apply_where(_coin(images), lambda values: tf.reverse(values, [axis]), images, labels)
+
+## Randomly transpose the height and width of each image in a batch, only for square images
+def random_transpose(images, labels=None):
+    return _apply_where(_coin(images), lambda values: tf.transpose(values, [0, 2, 1, 3]), images, labels)
+
+## Randomly flip and, if rotate is set, rotate each image in a batch by a multiple of 90 degrees. A transpose followed
+## by the two flips reaches all 8 rotations and reflections of a square. Every step is an index reversal or transpose on
+## the whole batch, so there is no interpolation and the labels come out bit exact.
+## Returns: the images and the labels, None if none were given
+def random_dihedral(images, labels=None, horizontal_flip=True, vertical_flip=True, rotate=False):
+    if rotate:
+        height, width = images.shape[1].value, images.shape[2].value
+        if height is None or height != width:
+            raise ValueError("Rotating by 90 degrees needs square images of a known size")
+
+        images, labels = random_transpose(images, labels)
+
+    if horizontal_flip:
+        images, labels = random_flip(images, 2, labels)
+
+    if vertical_flip:
+        images, labels = random_flip(images, 1, labels)
+
+    return images, labels
+
+## Randomly rotate by up to max_rotation degrees, shift by up to max_shift of the size and zoom by up to max_scale each
+## image in a batch, as a single projective warp. The images are interpolated bilinearly and the labels with the
+## nearest neighbour so the masks keep their values.
+## Returns: the images and the labels, None if none were given
+def random_affine(images, labels=None, max_rotation=0.0, max_shift=0.0, max_scale=0.0):
+    shape = tf.shape(images)
+    batch_size = shape[0]
+    height, width = tf.cast(shape[1], tf.float32), tf.cast(shape[2], tf.float32)
+
+    transforms = []
+
+    if max_rotation:
+        angles = tf.random_uniform([batch_size], -max_rotation, max_rotation) * math.pi / 180.0
+        transforms.append(tf.contrib.image.angles_to_projective_transforms(angles, height, width))
+
+    # the transforms map output pixels to input pixels, so the zoom is about the center and the inverse of the scale
+    if max_scale:
+        inverse_scale = 1.0 / tf.random_uniform([batch_size], 1.0 - max_scale, 1.0 + max_scale)
+        zeros = tf.zeros([batch_size])
+        transforms.append(tf.stack([inverse_scale, zeros, (1.0 - inverse_scale) * width / 2.0,
+                                    zeros, inverse_scale, (1.0 - inverse_scale) * height / 2.0,
+                                    zeros, zeros], axis=1))
+
+    if max_shift:
+        ones, zeros = tf.ones([batch_size]), tf.zeros([batch_size])
+        dx = tf.random_uniform([batch_size], -max_shift, max_shift) * width
+        dy = tf.random_uniform([batch_size], -max_shift, max_shift) * height
+        transforms.append(tf.stack([ones, zeros, dx, zeros, ones, dy, zeros, zeros], axis=1))
+
+    if not transforms:
+        return images, labels
+
+    transform = tf.contrib.image.compose_transforms(*transforms)
+    images = tf.contrib.image.transform(images, transform, interpolation='BILINEAR')
+
+    if labels is not None:
+        labels = tf.contrib.image.transform(labels, transform, interpolation='NEAREST')
+
+    return images, labels
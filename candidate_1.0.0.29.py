@@ -1,10 +1,16 @@
 import numpy as np
 import os
+import time
 import wget
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
+from profiling_utils import StepTracer
+from log_utils import MetricsLog
+from pipeline_utils import InputMonitor
+from eval_utils import PredictionWriter
 from training_utils import download_file, get_batches, read_and_decode_single_example, load_validation_data, \
-    download_data, evaluate_model, get_training_data, load_weights, flatten
+    download_data, evaluate_model, get_training_data, load_weights, load_validation_filenames, read_and_decode_dataset, \
+    annealed_ratio, abnormal_ratio_variable, abnormal_fraction
 import argparse
 from tensorboard import summary as summary_lib
 
@@ -16,8 +22,19 @@ parser.add_argument("-m", "--model", help="model to initialize with", default=No
 parser.add_argument("-l", "--label", help="how to classify data", default="label")
 parser.add_argument("-a", "--action", help="action to perform", default="train")
 parser.add_argument("-t", "--threshold", help="decision threshold", default=0.5, type=int)
+parser.add_argument("--trace", help="epochs:steps to trace, e.g. 0,-1:10-12 (none to turn off)", default="0,-1:10-12")
+parser.add_argument("--balance", help="fraction of each batch to sample from abnormal examples, optionally followed by "
+                    "the fraction to anneal it to by the last epoch", nargs="+", type=float, default=None)
 args = parser.parse_args()
 
+trace_schedule = args.trace
+
+if args.balance is not None:
+    abnormal_ratio = args.balance[0]
+    abnormal_ratio_end = args.balance[1] if len(args.balance) > 1 else None
+else:
+    abnormal_ratio = None
+
 epochs = args.epochs
 dataset = args.data
 init_model = args.model
@@ -111,10 +128,20 @@ with graph.as_default():
                                                staircase=staircase)
 
     with tf.name_scope('inputs') as scope:
-        image, label = read_and_decode_single_example(train_files, label_type=how, normalize=False)
+        # sample a fixed mix of normal and abnormal examples, changed each epoch if it is annealed
+        if abnormal_ratio is not None:
+            abnormal_ratio_var = abnormal_ratio_variable(abnormal_ratio)
 
-        X_def, y_def = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=2000,
-                                              min_after_dequeue=1000)
+            X_def, y_def = read_and_decode_dataset(train_files, batch_size, label_type=how, normalize=False,
+                                                   shuffle_buffer=1000, abnormal_ratio=abnormal_ratio_var, stats=True)
+
+            # the class mix that was actually sampled, to check it follows the ratio
+            tf.summary.scalar('abnormal_fraction', abnormal_fraction(y_def), collections=["summaries"])
+        else:
+            image, label = read_and_decode_single_example(train_files, label_type=how, normalize=False)
+
+            X_def, y_def = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=2000,
+                                                  min_after_dequeue=1000)
 
         # Placeholders
         X = tf.placeholder_with_default(X_def, shape=[None, 299, 299, 1])
@@ -673,41 +700,8 @@ checkpoint_every = 1  # how often to save model in epochs
 use_gpu = False  # whether or not to use the GPU
 print_metrics = True  # whether to print or plot metrics, if False a plot will be created and updated every epoch
 
-# Initialize metrics or load them from disk if they exist
-if os.path.exists(os.path.join("data", model_name + "train_acc.npy")):
-    train_acc_values = np.load(os.path.join("data", model_name + "train_acc.npy")).tolist()
-else:
-    train_acc_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_loss.npy")):
-    train_cost_values = np.load(os.path.join("data", model_name + "train_loss.npy")).tolist()
-else:
-    train_cost_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_lr.npy")):
-    train_lr_values = np.load(os.path.join("data", model_name + "train_lr.npy")).tolist()
-else:
-    train_lr_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_recall.npy")):
-    train_recall_values = np.load(os.path.join("data", model_name + "train_recall.npy")).tolist()
-else:
-    train_recall_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_acc.npy")):
-    valid_acc_values = np.load(os.path.join("data", model_name + "cv_acc.npy")).tolist()
-else:
-    valid_acc_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_loss.npy")):
-    valid_cost_values = np.load(os.path.join("data", model_name + "cv_loss.npy")).tolist()
-else:
-    valid_cost_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_recall.npy")):
-    valid_recall_values = np.load(os.path.join("data", model_name + "cv_recall.npy")).tolist()
-else:
-    valid_recall_values = []
+# log the metrics of each epoch, a restarted model carries on where its log left off
+metrics_log = MetricsLog(model_name)
 
 config = tf.ConfigProto()
 
@@ -759,20 +753,33 @@ with tf.Session(graph=graph, config=config) as sess:
         coord = tf.train.Coordinator()
         threads = tf.train.start_queue_runners(coord=coord)
 
+        # start the input pipeline if it is a tf.data one
+        sess.run(tf.get_collection('iterator_initializers'))
+
         print("Training model", model_name, "...")
 
+        # trace a few steps on a schedule, the rest run untraced
+        tracer = StepTracer(model_name, schedule=trace_schedule, epochs=epochs,
+                            writer=train_writer if log_to_tensorboard else None)
+
+        # split the step time into waiting for input and compute on a sample of the steps
+        monitor = InputMonitor(writer=train_writer if log_to_tensorboard else None)
+
         for epoch in range(epochs):
             sess.run(tf.local_variables_initializer())
 
+            if abnormal_ratio is not None:
+                abnormal_ratio_var.load(annealed_ratio(epoch, epochs, abnormal_ratio, abnormal_ratio_end), sess)
+
             # Accuracy values (train) after each batch
             batch_acc = []
             batch_cost = []
             batch_recall = []
 
             for i in range(steps_per_epoch):
-                # create the metadata
-                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
+                # only trace the steps in the trace schedule, or lightly trace a sample for the input monitor
+                trace_options = tracer.run_options(epoch, i) or monitor.run_options(i)
+                start_time = time.time()
 
                 # Run training op and update ops
                 if (i % 50 != 0) or (i == 0):
@@ -783,8 +790,7 @@ with tf.Session(graph=graph, config=config) as sess:
                             feed_dict={
                                 training: True,
                             },
-                            options=run_options,
-                            run_metadata=run_metadata)
+                            **trace_options)
 
                         # write the summary
                         train_writer.add_summary(image_summary, step)
@@ -794,8 +800,7 @@ with tf.Session(graph=graph, config=config) as sess:
                                 feed_dict={
                                     training: True,
                                 },
-                                options=run_options,
-                                run_metadata=run_metadata)
+                                **trace_options)
 
                 # every 50th step get the metrics
                 else:
@@ -804,8 +809,7 @@ with tf.Session(graph=graph, config=config) as sess:
                         feed_dict={
                             training: True,
                         },
-                        options=run_options,
-                        run_metadata=run_metadata)
+                        **trace_options)
 
                     # Save accuracy (current batch)
                     batch_acc.append(acc_value)
@@ -817,9 +821,12 @@ with tf.Session(graph=graph, config=config) as sess:
                         # write the summary
                         train_writer.add_summary(summary, step)
 
-                # only log the meta data once per epoch
-                if i == 1:
-                    train_writer.add_run_metadata(run_metadata, 'step %d' % step)
+                monitor.record(sess, time.time() - start_time, trace_options.get("run_metadata"), step)
+
+                # write the trace if this step was traced
+                tracer.record(epoch, i, step)
+
+            monitor.end_epoch(epoch)
 
             # save checkpoint every nth epoch
             if (epoch % checkpoint_every == 0):
@@ -876,29 +883,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
             print("Done evaluating...")
 
-            # take the mean of the values to add to the metrics
-            valid_acc_values.append(np.mean(batch_cv_acc))
-            train_acc_values.append(np.mean(batch_acc))
-
-            valid_cost_values.append(np.mean(batch_cv_loss))
-            train_cost_values.append(np.mean(batch_cost))
-
-            valid_recall_values.append(np.mean(batch_cv_recall))
-            train_recall_values.append(np.mean(batch_recall))
-
-            train_lr_values.append(lr)
-
-            # save the metrics
-            np.save(os.path.join("data", model_name + "train_acc.npy"), train_acc_values)
-            np.save(os.path.join("data", model_name + "cv_acc.npy"), valid_acc_values)
-
-            np.save(os.path.join("data", model_name + "train_loss.npy"), train_cost_values)
-            np.save(os.path.join("data", model_name + "cv_loss.npy"), valid_cost_values)
-
-            np.save(os.path.join("data", model_name + "train_recall.npy"), train_recall_values)
-            np.save(os.path.join("data", model_name + "cv_recall.npy"), valid_recall_values)
-
-            np.save(os.path.join("data", model_name + "train_lr.npy"), train_lr_values)
+            # log the mean of the values for the epoch
+            metrics_log.log(epoch, step, train_acc=np.mean(batch_acc), cv_acc=np.mean(batch_cv_acc),
+                            train_loss=np.mean(batch_cost), cv_loss=np.mean(batch_cv_loss),
+                            train_recall=np.mean(batch_recall), cv_recall=np.mean(batch_cv_recall), train_lr=lr)
 
             # Print progress every nth epoch to keep output to reasonable amount
             if (epoch % print_every == 0):
@@ -929,10 +917,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
     test_accuracy = []
     test_recall = []
-    test_predictions = []
-    ground_truth = []
-    for X_batch, y_batch in get_batches(X_te, y_te, batch_size, distort=False):
-        _, yhat, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, accuracy, rec_op], feed_dict=
+    test_filenames = load_validation_filenames(data="test", which=dataset)
+    prediction_writer = PredictionWriter(model_name, "test", len(y_te))
+    for X_batch, y_batch, filenames_batch in get_batches(X_te, y_te, batch_size, filenames=test_filenames, distort=False):
+        _, yhat, probs, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, probabilities, accuracy, rec_op], feed_dict=
         {
             X: X_batch,
             y: y_batch,
@@ -941,8 +929,7 @@ with tf.Session(graph=graph, config=config) as sess:
 
         test_accuracy.append(test_acc_value)
         test_recall.append(test_recall_value)
-        test_predictions.append(yhat)
-        ground_truth.append(y_batch)
+        prediction_writer.add(yhat, y_batch, probabilities=probs, filenames=filenames_batch)
 
     print("Evaluating on test data")
 
@@ -950,13 +937,8 @@ with tf.Session(graph=graph, config=config) as sess:
     print("Mean Test Accuracy:", np.mean(test_accuracy))
     print("Mean Test Recall:", np.mean(test_recall))
 
-    # unlist the predictions and truth
-    test_predictions = flatten(test_predictions)
-    ground_truth = flatten(ground_truth)
-
     # save the predictions and truth for review
-    np.save(os.path.join("data", "predictions_" + model_name + ".npy"), test_predictions)
-    np.save(os.path.join("data", "truth_" + model_name + ".npy"), ground_truth)
+    prediction_writer.close()
 
     sess.run(tf.local_variables_initializer())
 
@@ -965,10 +947,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
     mias_test_accuracy = []
     mias_test_recall = []
-    mias_test_predictions = []
-    mias_ground_truth = []
-    for X_batch, y_batch in get_batches(X_te, y_te, batch_size, distort=False):
-        _, yhat, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, accuracy, rec_op], feed_dict=
+    mias_filenames = load_validation_filenames(data="mias", which=dataset)
+    mias_prediction_writer = PredictionWriter(model_name, "mias", len(y_te))
+    for X_batch, y_batch, filenames_batch in get_batches(X_te, y_te, batch_size, filenames=mias_filenames, distort=False):
+        _, yhat, probs, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, probabilities, accuracy, rec_op], feed_dict=
         {
             X: X_batch,
             y: y_batch,
@@ -977,19 +959,13 @@ with tf.Session(graph=graph, config=config) as sess:
 
         mias_test_accuracy.append(test_acc_value)
         mias_test_recall.append(test_recall_value)
-        mias_test_predictions.append(yhat)
-        mias_ground_truth.append(y_batch)
+        mias_prediction_writer.add(yhat, y_batch, probabilities=probs, filenames=filenames_batch)
 
     # print the results
     print("Mean MIAS Accuracy:", np.mean(mias_test_accuracy))
     print("Mean MIAS Recall:", np.mean(mias_test_recall))
 
-    # unlist the predictions and truth
-    mias_test_predictions = flatten(mias_test_predictions)
-    mias_ground_truth = flatten(mias_ground_truth)
-
     # save the predictions and truth for review
-    np.save(os.path.join("data", "mias_predictions_" + model_name + ".npy"), mias_test_predictions)
-    np.save(os.path.join("data", "mias_truth_" + model_name + ".npy"), mias_ground_truth)
+    mias_prediction_writer.close()
 
 
@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import shutil
+import threading
+import tensorflow as tf
+
+## the json file that records a model's checkpoints
+def _state_path(model_dir, model_name):
+    return os.path.join(model_dir, model_name + ".checkpoints.json")
+
+## load the record of a model's checkpoints, empty if there isn't one
+def load_checkpoint_state(model_name, model_dir="model"):
+    path = _state_path(model_dir, model_name)
+    if not os.path.exists(path):
+        return {"latest": None, "kept": []}
+
+    with open(path) as f:
+        return json.load(f)
+
+## Get the prefix of the latest complete checkpoint of a model, or None if it has none. Checkpoints written by the
+## AsyncCheckpointer are found through its state file, otherwise falls back to ./model/<name>.ckpt
+def latest_checkpoint(model_name, model_dir="model"):
+    state = load_checkpoint_state(model_name, model_dir)
+    if state["latest"] is not None and os.path.exists(state["latest"] + ".index"):
+        return state["latest"]
+
+    prefix = os.path.join(model_dir, model_name + ".ckpt")
+    if os.path.exists(prefix + ".index"):
+        return prefix
+
+    return None
+
+## remove the files of a checkpoint, the index goes first so a partly removed checkpoint is never loaded
+def _remove_checkpoint(prefix):
+    if os.path.exists(prefix + ".index"):
+        os.remove(prefix + ".index")
+
+    for path in glob.glob(prefix + ".*"):
+        os.remove(path)
+
+## the files of a complete checkpoint, raises IOError if it is missing its index or any of its data shards
+def _checkpoint_files(prefix):
+    files = [path for path in glob.glob(prefix + ".*") if not path.endswith(".tmp")]
+    suffixes = set(path[len(prefix):] for path in files)
+
+    # the data files are .data-<shard>-of-<shards>
+    shards = [suffix for suffix in suffixes if suffix.startswith(".data-")]
+    complete = ".index" in suffixes and len(shards) > 0 and \
+        all(len(shards) == int(suffix.split("-of-")[1]) for suffix in shards)
+
+    if not complete:
+        raise IOError("Checkpoint " + prefix + " is missing or incomplete")
+
+    return files
+
+## Make the checkpoint at src_prefix available as dst_prefix. The files are hard linked where possible so this costs no
+## extra disk writes, or moved if move is set. Every file is first put next to its destination under a temporary name,
+## then they are renamed over the old ones with the index last, so a crash or a source which is removed part way never
+## loses the checkpoint already at dst_prefix. Stale files of the old checkpoint are only removed after that.
+## Raises IOError if the checkpoint at src_prefix is missing or incomplete, leaving dst_prefix as it was.
+def _publish(src_prefix, dst_prefix, move=False):
+    src_files = sorted(_checkpoint_files(src_prefix), key=lambda path: path.endswith(".index"))
+
+    staged = []
+    try:
+        for src in src_files:
+            dst = dst_prefix + src[len(src_prefix):]
+            tmp = dst + ".tmp"
+
+            if move:
+                shutil.move(src, tmp)
+            else:
+                try:
+                    os.link(src, tmp)
+                except OSError:
+                    shutil.copyfile(src, tmp)
+
+            staged.append((tmp, dst))
+    except (IOError, OSError):
+        # the source went away while it was being linked, leave the destination alone
+        for tmp, _ in staged:
+            os.remove(tmp)
+
+        raise IOError("Checkpoint " + src_prefix + " was removed while it was being published")
+
+    # the data first and the index last
+    for tmp, dst in staged:
+        os.replace(tmp, dst)
+
+    published = set(dst for _, dst in staged)
+    for path in glob.glob(dst_prefix + ".*"):
+        if path not in published and not path.endswith(".tmp"):
+            os.remove(path)
+
+## Keep a copy of a checkpoint as ./model/<name>.best.ckpt if its metric is higher than the best so far. The best metric
+## is recorded in ./model/<name>.best.json. Returns True if the checkpoint is the new best.
+def update_best(model_name, prefix, metric, model_dir="model"):
+    path = os.path.join(model_dir, model_name + ".best.json")
+
+    if os.path.exists(path):
+        with open(path) as f:
+            best = json.load(f)
+
+        if metric <= best["metric"]:
+            return False
+
+    # the trainer may have rotated the checkpoint out already, then the best so far stays as it is
+    try:
+        _publish(prefix, os.path.join(model_dir, model_name + ".best.ckpt"))
+    except IOError as e:
+        print(e)
+        return False
+
+    with open(path + ".tmp", "w") as f:
+        json.dump({"checkpoint": prefix, "metric": float(metric)}, f, indent=4)
+
+    os.replace(path + ".tmp", path)
+
+    return True
+
+## Saves checkpoints without stalling training. save() copies the variables to host memory, which is fast, and a
+## background thread writes them to disk through a copy of the variables in a separate graph. Each checkpoint is
+## written to a temporary directory and only moved into place once complete, so a crash mid-save never leaves a
+## corrupt checkpoint.
+## The last keep checkpoints are kept as ./model/<name>-<step>.ckpt, the one with the highest metric is kept as
+## ./model/<name>.best.ckpt and the latest is also available as ./model/<name>.ckpt for load_weights and the scripts.
+## Create it inside the graph whose variables it saves.
+class AsyncCheckpointer(object):
+    def __init__(self, model_name, variables=None, keep=3, model_dir="model"):
+        self.model_name = model_name
+        self.keep = keep
+        self.model_dir = model_dir
+        self.variables = variables if variables is not None else tf.global_variables()
+
+        # a copy of the variables with the same names, so the checkpoints can be restored into the training graph
+        self.shadow_graph = tf.Graph()
+        with self.shadow_graph.as_default():
+            self.placeholders = []
+            shadow_variables = {}
+            for variable in self.variables:
+                placeholder = tf.placeholder(variable.dtype.base_dtype, shape=variable.shape)
+                shadow_variables[variable.op.name] = tf.Variable(placeholder, name=variable.op.name, trainable=False)
+                self.placeholders.append(placeholder)
+
+            self.load_op = tf.variables_initializer(list(shadow_variables.values()))
+            self.saver = tf.train.Saver(shadow_variables, max_to_keep=None)
+
+        self.shadow_sess = tf.Session(graph=self.shadow_graph)
+        self.state = load_checkpoint_state(model_name, model_dir)
+        self.thread = None
+        self.error = None
+
+        if not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+
+    # write the state file atomically
+    def _write_state(self):
+        path = _state_path(self.model_dir, self.model_name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.state, f, indent=4)
+
+        os.replace(path + ".tmp", path)
+
+    # write a snapshot of the variables to disk, runs on the background thread
+    def _write(self, values, step, metric):
+        tmp_dir = os.path.join(self.model_dir, ".tmp_" + self.model_name)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        self.shadow_sess.run(self.load_op, feed_dict=dict(zip(self.placeholders, values)))
+        tmp_prefix = self.saver.save(self.shadow_sess, os.path.join(tmp_dir, "ckpt"), write_meta_graph=False,
+                                     write_state=False)
+
+        prefix = os.path.join(self.model_dir, "{}-{}.ckpt".format(self.model_name, step))
+        _publish(tmp_prefix, prefix, move=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        if metric is not None:
+            update_best(self.model_name, prefix, metric, self.model_dir)
+
+        _publish(prefix, os.path.join(self.model_dir, self.model_name + ".ckpt"))
+
+        # drop the oldest checkpoints, the best and latest are separate links so aren't affected
+        kept = [path for path in self.state["kept"] if path != prefix] + [prefix]
+        while len(kept) > self.keep:
+            _remove_checkpoint(kept.pop(0))
+
+        self.state["kept"] = kept
+        self.state["latest"] = prefix
+        self._write_state()
+
+    def _run(self, values, step, metric):
+        try:
+            self._write(values, step, metric)
+        except Exception as e:
+            self.error = e
+
+    # wait for the checkpoint being written, if any, raising any error it had
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    # Snapshot the variables and write them in the background. metric is higher for better models, e.g. the
+    # validation iou, and is used to pick the best checkpoint, leave it out if the checkpoints are evaluated
+    # elsewhere. Only waits if the previous checkpoint is still being written.
+    def save(self, sess, step, metric=None):
+        values = sess.run(self.variables)
+
+        self.wait()
+        self.thread = threading.Thread(target=self._run, args=(values, step, metric))
+        self.thread.start()
+
+    # wait for the last checkpoint to be written
+    def close(self):
+        self.wait()
+        self.shadow_sess.close()
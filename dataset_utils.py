@@ -0,0 +1,181 @@
+import numpy as np
+import os
+import json
+import hashlib
+import tensorflow as tf
+
+# directory holding one json manifest per dataset
+MANIFEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "datasets")
+
+# directory the scanned manifests are cached in
+CATALOG_DIR = os.path.join("data", "catalog")
+
+# the manifests keyed by dataset id, loaded on first use
+_catalog = None
+
+## load every manifest in the datasets directory into a dict keyed by dataset id. This is only done once per run so
+## looking up a dataset is a dict lookup.
+def load_catalog():
+    global _catalog
+
+    if _catalog is None:
+        catalog = {}
+        for manifest_file in sorted(os.listdir(MANIFEST_DIR)):
+            if not manifest_file.endswith(".json"):
+                continue
+
+            with open(os.path.join(MANIFEST_DIR, manifest_file)) as f:
+                manifest = json.load(f)
+
+            catalog[manifest["id"]] = manifest
+
+        _catalog = catalog
+
+    return _catalog
+
+## get the manifest for a dataset, returns None if the dataset is not in the catalog
+def get_dataset(what):
+    return load_catalog().get(what)
+
+## path to a file in the data directory, manifests use forward slashes for subdirectories
+def data_path(file):
+    return os.path.join("data", *file.split("/"))
+
+## sha256 of a file, read in chunks so large shards don't have to fit in memory
+def _file_checksum(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+## read the first record of a shard to work out the image size and which labels are stored with each record
+def _inspect_record(path):
+    for record in tf.python_io.tf_record_iterator(path):
+        example = tf.train.Example.FromString(record)
+        features = example.features.feature
+
+        image_size = int(np.sqrt(len(features["image"].bytes_list.value[0])))
+
+        # masks are stored as raw bytes, class labels as ints
+        if features["label"].bytes_list.value:
+            labels = ["label_mask"]
+        else:
+            labels = sorted([key for key in features.keys() if key.startswith("label")])
+
+        return image_size, labels
+
+    return None, None
+
+## scan a single shard, counting the records and computing the checksum
+def _scan_shard(path):
+    records = 0
+    for _ in tf.python_io.tf_record_iterator(path):
+        records += 1
+
+    stat = os.stat(path)
+
+    return {
+        "records": records,
+        "sha256": _file_checksum(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime
+    }
+
+## Build the catalog entry for a dataset by scanning its training shards. The result is cached in data/catalog and
+## a shard is only re-scanned if its size or modification time changes, so this is only slow the first time.
+def build_catalog(what, force=False):
+    manifest = get_dataset(what)
+    if manifest is None:
+        raise ValueError('Invalid dataset!')
+
+    cache_path = os.path.join(CATALOG_DIR, str(what) + ".json")
+
+    cached = {}
+    if os.path.exists(cache_path) and not force:
+        with open(cache_path) as f:
+            cached = json.load(f)
+
+    entry = dict(manifest)
+    entry["shards"] = {}
+    changed = False
+
+    for shard in manifest.get("training", {}).get("shards", []):
+        path = data_path(shard)
+        if not os.path.exists(path):
+            continue
+
+        stat = os.stat(path)
+        shard_info = cached.get("shards", {}).get(shard)
+        if shard_info is None or shard_info["size"] != stat.st_size or shard_info["mtime"] != stat.st_mtime:
+            print("Scanning", path)
+            shard_info = _scan_shard(path)
+            changed = True
+
+        # a checksum in the manifest means the shard must match it
+        expected = manifest.get("checksums", {}).get(shard)
+        if expected is not None and expected != shard_info["sha256"]:
+            raise ValueError("Checksum mismatch for " + path)
+
+        entry["shards"][shard] = shard_info
+
+    # fill in anything the manifest doesn't specify from the first shard
+    if entry["shards"] and (entry.get("image_size") is None or entry.get("labels") is None):
+        image_size, labels = cached.get("image_size"), cached.get("labels")
+        if changed or image_size is None:
+            image_size, labels = _inspect_record(data_path(sorted(entry["shards"])[0]))
+
+        if entry.get("image_size") is None:
+            entry["image_size"] = image_size
+        if entry.get("labels") is None:
+            entry["labels"] = labels
+
+    if changed or len(entry["shards"]) != len(cached.get("shards", {})):
+        if not os.path.exists(CATALOG_DIR):
+            os.makedirs(CATALOG_DIR)
+
+        with open(cache_path, "w") as f:
+            json.dump(entry, f, indent=4)
+
+    return entry
+
+## Get the list of training shards and the number of records in them. If every shard is available locally the count
+## comes from scanning them, otherwise it falls back to the count published in the manifest.
+def training_records(what):
+    manifest = get_dataset(what)
+    if manifest is None or "shards" not in manifest.get("training", {}):
+        raise ValueError('Invalid dataset!')
+
+    shards = manifest["training"]["shards"]
+    train_files = [data_path(shard) for shard in shards]
+
+    # only scan once per run
+    entry = manifest.get("scanned")
+    if entry is None:
+        entry = build_catalog(what)
+
+    if len(entry["shards"]) == len(shards):
+        manifest["scanned"] = entry
+        total_records = sum([entry["shards"][shard]["records"] for shard in shards])
+
+        published = manifest["training"].get("records")
+        if published is not None and published != total_records:
+            print("Warning: dataset", what, "has", total_records, "records but the manifest lists", published)
+    else:
+        total_records = manifest["training"].get("records")
+
+        if total_records is None:
+            raise ValueError('Training data for dataset ' + str(what) + ' not found, run download_data first')
+
+    return train_files, total_records
+
+## get the paths to the data, labels and (if available) filenames for a split of a dataset
+def split_files(what, split):
+    manifest = get_dataset(what)
+    if manifest is None or split not in manifest["splits"]:
+        return None
+
+    files = manifest["splits"][split]
+
+    return {key: data_path(file) for key, file in files.items()}
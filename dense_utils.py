@@ -1,27 +1,39 @@
 import tensorflow as tf
-
-def _dense_block(input, layers, growth_rate=12, bottleneck=False, training=tf.placeholder(dtype=tf.bool, name="is_training"), seed=None, name=None, activation="relu"):
+from memory_utils import recompute
+
+## A dense block, each layer after the first two reads the concatenation of the outputs of the layers before it, through
+## a bottleneck if set. With efficient set each of those layers, the concatenation, batch norms, activations and
+## convolutions, isn't kept for the backward pass but recomputed from the layer outputs, so the block only keeps its
+## growth_rate wide layer outputs and its memory grows linearly with its layers rather than quadratically, for about
+## one more forward pass of the block per step. It only matters for training and doesn't change the variables, so a
+## model trained either way loads into the other.
+def _dense_block(input, layers, growth_rate=12, bottleneck=False, training=tf.placeholder(dtype=tf.bool, name="is_training"), seed=None, name=None, activation="relu", efficient=False):
     # with tf.name_scope('block_' + name) as scope:
     # input layer
-    layer1 = _dense_layer(input, growth_rate, training=training, name=name + "_layer1")
+    layer1 = _dense_layer(input, growth_rate, training=training, name=name + "_layer1", activation=activation)
 
-    layer2 = _dense_layer(layer1, growth_rate, training=training, name=name + "_layer2")
+    layer2 = _dense_layer(layer1, growth_rate, training=training, name=name + "_layer2", activation=activation)
 
     concat_inputs = [layer1, layer2]
 
     for i in range(2, layers):
-        # concat the inputs
-        layer_inputs = tf.concat(concat_inputs,
-                                axis=3,
-                                name="concat_"+name+"_" + str(i))
+        # the layer reads the concatenation of the outputs so far, through the optional bottleneck
+        def dense_layer(*features, i=i):
+            layer_inputs = list(features)
 
-        # optional bottleneck
-        if bottleneck:
-            layer_inputs = _bottleneck(input, growth_rate, training = training, name=name + "_bottleneck_" + str(i))
+            if bottleneck:
+                layer_inputs = _bottleneck(layer_inputs, growth_rate, training=training,
+                                           name=name + "_bottleneck_" + str(i), activation=activation)
 
-        layers = _dense_layer(layer_inputs, growth_rate, training=training, name=name + "_layer_" + str(i))
+            return _dense_layer(layer_inputs, growth_rate, training=training, name=name + "_layer_" + str(i),
+                                activation=activation)
 
-        concat_inputs.append(layers)
+        if efficient:
+            layer = recompute(dense_layer, *concat_inputs)
+        else:
+            layer = dense_layer(*concat_inputs)
+
+        concat_inputs.append(layer)
 
     output = tf.concat(concat_inputs,
                                 axis=3,
@@ -29,31 +41,45 @@ def _dense_block(input, layers, growth_rate=12, bottleneck=False, training=tf.pl
 
     return output
 
+## batch norm then the activation of the input, which can be a list of feature maps to concatenate first
+def _bn_activation(input, training, epsilon=1e-8, name=None, activation="relu", prefix=""):
+    if isinstance(input, (list, tuple)) and len(input) > 1:
+        layer = tf.concat(list(input), axis=3, name=prefix + "concat_" + name)
+    elif isinstance(input, (list, tuple)):
+        layer = input[0]
+    else:
+        layer = input
+
+    # batch norm
+    layer = tf.layers.batch_normalization(
+            layer,
+            axis=-1,
+            momentum=0.99,
+            epsilon=epsilon,
+            center=True,
+            scale=True,
+            beta_initializer=tf.zeros_initializer(),
+            gamma_initializer=tf.ones_initializer(),
+            moving_mean_initializer=tf.zeros_initializer(),
+            moving_variance_initializer=tf.ones_initializer(),
+            training=training,
+            name=prefix + 'bn_' + name
+        )
+
+    # activation
+    if activation == "relu":
+        # apply relu
+        layer = tf.nn.relu(layer, name=prefix + 'relu_' + name)
+    elif activation == "elu":
+        layer = tf.nn.elu(layer, name=prefix + "elu_" + name)
+
+    return layer
+
 def _dense_layer(input, filters, stride=(1,1), training = tf.placeholder(dtype=tf.bool, name="is_training"), epsilon=1e-8, padding="SAME", seed=None, lambd=0.0, name=None, activation="relu"):
 
     with tf.name_scope('dense_'+name) as scope:
-        # batch norm
-        layer = tf.layers.batch_normalization(
-                input,
-                axis=-1,
-                momentum=0.99,
-                epsilon=epsilon,
-                center=True,
-                scale=True,
-                beta_initializer=tf.zeros_initializer(),
-                gamma_initializer=tf.ones_initializer(),
-                moving_mean_initializer=tf.zeros_initializer(),
-                moving_variance_initializer=tf.ones_initializer(),
-                training=training,
-                name='bn_'+name
-            )
-
-        # activation
-        if activation == "relu":
-            # apply relu
-            layer = tf.nn.relu(layer, name='relu_' + name)
-        elif activation == "elu":
-            layer = tf.nn.elu(layer, name="elu_" + name)
+        # batch norm and activation
+        layer = _bn_activation(input, training, epsilon=epsilon, name=name, activation=activation)
 
         # 3x3 convolution
         layer = tf.layers.conv2d(
@@ -114,28 +140,8 @@ def _transition(input, filters, training = tf.placeholder(dtype=tf.bool, name="i
 
 def _bottleneck(input, growth_rate, training = tf.placeholder(dtype=tf.bool, name="is_training"), epsilon=1e-8, padding="SAME", seed=None, lambd=0.0, name=None, activation="relu"):
     with tf.name_scope('bottleneck_' + name) as scope:
-        # batch norm
-        layer = tf.layers.batch_normalization(
-                input,
-                axis=-1,
-                momentum=0.99,
-                epsilon=epsilon,
-                center=True,
-                scale=True,
-                beta_initializer=tf.zeros_initializer(),
-                gamma_initializer=tf.ones_initializer(),
-                moving_mean_initializer=tf.zeros_initializer(),
-                moving_variance_initializer=tf.ones_initializer(),
-                training=training,
-                name='bottleneck_bn_'+name
-            )
-
-        # activation
-        if activation == "relu":
-            # apply relu
-            layer = tf.nn.relu(layer, name='bottleneck_relu_' + name)
-        elif activation == "elu":
-            layer = tf.nn.elu(layer, name="bottleneck_elu_" + name)
+        # batch norm and activation
+        layer = _bn_activation(input, training, epsilon=epsilon, name=name, activation=activation, prefix="bottleneck_")
 
         # 1x1 convolution
         layer = tf.layers.conv2d(
@@ -150,4 +156,4 @@ def _bottleneck(input, growth_rate, training = tf.placeholder(dtype=tf.bool, nam
                 name='bottleneck_'+name
             )
 
-    return layer
\ No newline at end of file
+    return layer
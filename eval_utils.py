@@ -0,0 +1,285 @@
+import numpy as np
+import os
+import json
+import shutil
+
+# directory the raw probabilities of each model are stored in
+PROBABILITY_DIR = os.path.join("data", "probabilities")
+
+# directory the predictions of each model are stored in
+PREDICTION_DIR = os.path.join("data", "predictions")
+
+# the type each prediction column is stored as, filenames are stored as fixed width strings
+_COLUMN_TYPES = {
+    "probabilities": np.float16,
+    "predictions": np.uint8,
+    "truth": np.uint8
+}
+
+## the directory the predictions of a model on a split are stored in, one .npy file per column
+def prediction_dir(model_name, split):
+    return os.path.join(PREDICTION_DIR, model_name + "_" + split)
+
+## Stores the predictions of a model on a split in columns, one .npy file each for the probabilities, predicted labels,
+## truth and filenames. Each column is preallocated for the whole split when the first batch is added and the batches
+## are written straight into it, so nothing is held in memory. The columns are written to a temporary directory which
+## close() moves into place, so a partly written store is never read.
+class PredictionWriter(object):
+    def __init__(self, model_name, split, num_examples, filename_length=64):
+        self.path = prediction_dir(model_name, split)
+        self.tmp_path = self.path + ".tmp"
+        self.num_examples = num_examples
+        self.filename_length = filename_length
+        self.columns = None
+        self.count = 0
+
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+
+    # create the columns from the shapes of the first batch
+    def _open(self, batch):
+        self.columns = {}
+        for name, values in batch.items():
+            if name == "filenames":
+                length = max(self.filename_length, values.dtype.itemsize // np.dtype("U1").itemsize)
+                dtype = np.dtype("U{}".format(length))
+            else:
+                dtype = _COLUMN_TYPES[name]
+
+            self.columns[name] = np.lib.format.open_memmap(os.path.join(self.tmp_path, name + ".npy"), mode="w+",
+                                                           dtype=dtype, shape=(self.num_examples,) + values.shape[1:])
+
+    # add a batch, probabilities and filenames are optional but must be given for every batch or none
+    def add(self, predictions, truth, probabilities=None, filenames=None):
+        batch = {"predictions": np.asarray(predictions), "truth": np.asarray(truth)}
+        if probabilities is not None:
+            batch["probabilities"] = np.asarray(probabilities)
+        if filenames is not None:
+            batch["filenames"] = np.asarray(filenames).astype(str)
+
+        if self.columns is None:
+            self._open(batch)
+
+        n = len(batch["predictions"])
+        for name, column in self.columns.items():
+            column[self.count:self.count + n] = batch[name]
+
+        self.count += n
+
+    def close(self):
+        columns = []
+        if self.columns is not None:
+            for name, column in self.columns.items():
+                column.flush()
+                columns.append(name)
+
+            del self.columns
+
+        with open(os.path.join(self.tmp_path, "meta.json"), "w") as f:
+            json.dump({"count": self.count, "columns": sorted(columns)}, f, indent=4)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+## Open the stored predictions of a model on a split as read only memmaps, so loading is instant however big the split
+## is and only the parts that are used are read.
+## Returns: a dict of the columns, each with one row per example
+def load_predictions(model_name, split):
+    path = prediction_dir(model_name, split)
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+
+    return {name: np.load(os.path.join(path, name + ".npy"), mmap_mode="r")[:meta["count"]] for name in meta["columns"]}
+
+## the models that have stored predictions on a split
+def list_predictions(split="test"):
+    if not os.path.exists(PREDICTION_DIR):
+        return []
+
+    suffix = "_" + split
+    return sorted([name[:-len(suffix)] for name in os.listdir(PREDICTION_DIR)
+                   if name.endswith(suffix) and os.path.exists(os.path.join(PREDICTION_DIR, name, "meta.json"))])
+
+## paths to the stored probabilities and labels of a model on a split
+def probability_paths(model_name, split):
+    prefix = os.path.join(PROBABILITY_DIR, model_name + "_" + split)
+
+    return prefix + "_probabilities.npy", prefix + "_labels.npy"
+
+## Stores the raw probabilities of a model on a split as a float16 memmap along with the labels, so the test set only
+## has to be run through the model once however many thresholds are looked at. The files are written under a temporary
+## name and renamed by close() so a partly written store is never read.
+class ProbabilityWriter(object):
+    def __init__(self, model_name, split, num_examples, shape=()):
+        if not os.path.exists(PROBABILITY_DIR):
+            os.makedirs(PROBABILITY_DIR)
+
+        self.paths = probability_paths(model_name, split)
+        self.probabilities = np.lib.format.open_memmap(self.paths[0] + ".tmp", mode="w+", dtype=np.float16,
+                                                       shape=(num_examples,) + tuple(shape))
+        self.labels = np.lib.format.open_memmap(self.paths[1] + ".tmp", mode="w+", dtype=np.uint8,
+                                                shape=(num_examples,) + tuple(shape))
+        self.count = 0
+
+    # add a batch of probabilities and labels
+    def add(self, probabilities, labels):
+        n = len(probabilities)
+        self.probabilities[self.count:self.count + n] = probabilities
+        self.labels[self.count:self.count + n] = labels
+        self.count += n
+
+    def close(self):
+        self.probabilities.flush()
+        self.labels.flush()
+        del self.probabilities, self.labels
+
+        for path in self.paths:
+            os.replace(path + ".tmp", path)
+
+## open the stored probabilities and labels of a model on a split as read only memmaps
+def load_probabilities(model_name, split):
+    probabilities_path, labels_path = probability_paths(model_name, split)
+
+    return np.load(probabilities_path, mmap_mode="r"), np.load(labels_path, mmap_mode="r")
+
+## path the threshold sweep of a model on a split is saved to
+def sweep_path(model_name, split):
+    return os.path.join(PROBABILITY_DIR, model_name + "_" + split + "_sweep.npz")
+
+## divide, giving 0 where the denominator is 0
+def _safe_divide(numerator, denominator):
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1), 0.0)
+
+## the metrics at each threshold from the confusion counts
+def _metrics(tp, fp, tn, fn):
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+
+    return {
+        "accuracy": _safe_divide(tp + tn, tp + fp + tn + fn),
+        "precision": precision,
+        "recall": recall,
+        "specificity": _safe_divide(tn, tn + fp),
+        "f1": _safe_divide(2 * precision * recall, precision + recall),
+        "tp": tp,
+        "fp": fp,
+        "tn": tn,
+        "fn": fn
+    }
+
+## the probability bin of each value, a value is predicted positive at threshold k if its bin is >= k
+def _bins(probabilities, num_thresholds):
+    return np.clip((probabilities.astype(np.float32) * num_thresholds).astype(np.int64), 0, num_thresholds - 1)
+
+## number predicted positive at each threshold from a histogram by bin, highest bin last
+def _positives(histogram):
+    return np.cumsum(histogram[..., ::-1], axis=-1)[..., ::-1]
+
+## Compute the metrics at num_thresholds evenly spaced thresholds from stored probabilities in a single pass over them.
+## Threshold k is k / num_thresholds. Each chunk of probabilities is binned and reduced to histograms, so the cost
+## doesn't depend on the number of thresholds.
+## For segmentations (probabilities of shape (n, height, width)) returns pixel_ and image_ metrics, where an image is
+## predicted positive if more than min_pixels of its pixels are, by default size * size // 750 like the models use.
+## For per example probabilities (shape (n,), or (n, classes) where class 0 is normal) returns the metrics per example.
+## Returns: a dict with the thresholds and an array of each metric at each threshold
+def threshold_sweep(probabilities, labels, num_thresholds=200, min_pixels=None, chunk_size=64):
+    thresholds = np.arange(num_thresholds) / float(num_thresholds)
+
+    # per example probabilities, the probability of being abnormal is 1 - the probability of being normal
+    if probabilities.ndim <= 2:
+        scores = np.asarray(probabilities, dtype=np.float32)
+        if scores.ndim == 2:
+            scores = 1 - scores[:, 0]
+
+        truth = (np.asarray(labels) > 0).astype(np.int64)
+        histogram = np.bincount(_bins(scores, num_thresholds) * 2 + truth, minlength=2 * num_thresholds)
+        histogram = histogram.reshape(num_thresholds, 2)
+
+        tp, fp = _positives(histogram[:, 1]), _positives(histogram[:, 0])
+        sweep = _metrics(tp, fp, histogram[:, 0].sum() - fp, histogram[:, 1].sum() - tp)
+        sweep["thresholds"] = thresholds
+
+        return sweep
+
+    if min_pixels is None:
+        min_pixels = probabilities.shape[1] * probabilities.shape[2] // 750
+
+    pixel_histogram = np.zeros((num_thresholds, 2), dtype=np.int64)
+    image_counts = np.zeros((2, num_thresholds), dtype=np.int64)
+    images_true = 0
+
+    for i in range(0, len(probabilities), chunk_size):
+        n = min(chunk_size, len(probabilities) - i)
+        bins = _bins(probabilities[i:i + n].reshape(n, -1), num_thresholds)
+        truth = (labels[i:i + n].reshape(n, -1) > 0).astype(np.int64)
+
+        pixel_histogram += np.bincount((bins * 2 + truth).ravel(), minlength=2 * num_thresholds).reshape(num_thresholds, 2)
+
+        # the number of positive pixels in each image at each threshold
+        image_histogram = np.bincount((bins + np.arange(n)[:, np.newaxis] * num_thresholds).ravel(),
+                                      minlength=n * num_thresholds).reshape(n, num_thresholds)
+        image_predictions = _positives(image_histogram) > min_pixels
+        image_truth = truth.max(axis=1).astype(bool)
+
+        image_counts[0] += image_predictions[image_truth].sum(axis=0)
+        image_counts[1] += image_predictions[~image_truth].sum(axis=0)
+        images_true += image_truth.sum()
+
+    tp, fp = _positives(pixel_histogram[:, 1]), _positives(pixel_histogram[:, 0])
+    pixel_sweep = _metrics(tp, fp, pixel_histogram[:, 0].sum() - fp, pixel_histogram[:, 1].sum() - tp)
+
+    images_false = len(probabilities) - images_true
+    tp, fp = image_counts
+    image_sweep = _metrics(tp, fp, images_false - fp, images_true - tp)
+
+    sweep = {"thresholds": thresholds}
+    sweep.update({"pixel_" + key: value for key, value in pixel_sweep.items()})
+    sweep.update({"image_" + key: value for key, value in image_sweep.items()})
+
+    return sweep
+
+## print a table of the sweep at every step'th threshold
+def print_sweep(sweep, step=0.1):
+    every = max(int(round(step * len(sweep["thresholds"]))), 1)
+    columns = [key for key in ("recall", "precision", "specificity",
+                               "pixel_recall", "pixel_precision", "image_recall", "image_precision", "image_specificity")
+               if key in sweep]
+
+    print("threshold\t" + "\t".join(columns))
+    for k in range(0, len(sweep["thresholds"]), every):
+        print("{:.3f}\t\t".format(sweep["thresholds"][k]) + "\t".join(["{:.4f}".format(sweep[key][k]) for key in columns]))
+
+## Sweep the thresholds over the stored outputs of a model on a split without running the model, and save the sweep to
+## sweep_path. The segmentation models store their probabilities with a ProbabilityWriter, the classifiers with a
+## PredictionWriter, whichever the model has is used.
+## Returns: the sweep, see threshold_sweep
+def sweep_model(model_name, split="test", num_thresholds=200):
+    if os.path.exists(probability_paths(model_name, split)[0]):
+        probabilities, labels = load_probabilities(model_name, split)
+    else:
+        columns = load_predictions(model_name, split)
+        if "probabilities" not in columns:
+            raise ValueError("the predictions of {} on {} were stored without probabilities".format(model_name, split))
+
+        probabilities, labels = columns["probabilities"], columns["truth"]
+
+    sweep = threshold_sweep(probabilities, labels, num_thresholds=num_thresholds)
+
+    if not os.path.exists(PROBABILITY_DIR):
+        os.makedirs(PROBABILITY_DIR)
+
+    np.savez(sweep_path(model_name, split), **sweep)
+
+    return sweep
+
+# sweep the stored predictions of a model, e.g. python eval_utils.py model_s3.9.4.02m.12 test
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("model", help="name of the model whose stored predictions to sweep")
+    parser.add_argument("split", help="split the predictions were made on (default test)", nargs="?", default="test")
+    parser.add_argument("-n", "--thresholds", help="number of thresholds to sweep", default=200, type=int)
+    args = parser.parse_args()
+
+    print_sweep(sweep_model(args.model, args.split, num_thresholds=args.thresholds))
@@ -0,0 +1,204 @@
+import numpy as np
+import os
+import time
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+# layers whose kernel has the output channels as its last axis, batch norm can be folded into these
+_FOLDABLE_OPS = ("Conv2D", "MatMul")
+
+## the name of the node an input refers to, without the output index or control dependency marker
+def _node_name(input_name):
+    return input_name.lstrip("^").split(":")[0]
+
+## get the value of a constant, following any identity ops, returns None if it isn't a constant
+def _const_value(nodes, name):
+    node = nodes[_node_name(name)]
+    while node.op == "Identity":
+        node = nodes[_node_name(node.input[0])]
+
+    if node.op != "Const":
+        return None
+
+    return tf.make_ndarray(node.attr["value"].tensor)
+
+## create a float32 constant node
+def _const_node(name, value):
+    node = tf.NodeDef()
+    node.op = "Const"
+    node.name = name
+    node.attr["dtype"].type = tf.float32.as_datatype_enum
+    node.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float32)))
+
+    return node
+
+## map each node name to the inputs of other nodes that refer to it
+def _consumers(graph_def):
+    consumers = {node.name: [] for node in graph_def.node}
+    for node in graph_def.node:
+        for input_name in node.input:
+            consumers[_node_name(input_name)].append(input_name)
+
+    return consumers
+
+## Fold output = layer(x) * scale + shift into the layer's kernel and bias, where layer is a conv or dense layer with
+## constant weights, optionally followed by a BiasAdd. node is rewritten in place as a BiasAdd of the layer so
+## anything using its output is unchanged. Returns the new constant nodes, or None if the layer can't be folded.
+def _fold_into_layer(nodes, consumers, node, x_name, scale, shift):
+    x = nodes[_node_name(x_name)]
+
+    bias = None
+    if x.op == "BiasAdd":
+        bias = _const_value(nodes, x.input[1])
+        if bias is None:
+            return None
+
+        layer = nodes[_node_name(x.input[0])]
+    else:
+        layer = x
+
+    # the layer's output can only be used by the op being folded into it
+    if layer.op not in _FOLDABLE_OPS or len(consumers[layer.name]) != 1 or len(consumers[x.name]) != 1:
+        return None
+
+    if layer.op == "MatMul" and layer.attr["transpose_b"].b:
+        return None
+
+    kernel = _const_value(nodes, layer.input[1])
+    if kernel is None:
+        return None
+
+    if bias is None:
+        bias = np.zeros(kernel.shape[-1], dtype=np.float32)
+
+    # The output channels are the last axis of the kernel. The constants are named after the node being folded, the
+    # mul and the add of a non-fused batch norm are both folded into the same layer so its name isn't unique.
+    scale = np.broadcast_to(scale, bias.shape)
+    folded_kernel = _const_node(node.name + "/folded_kernel", kernel * scale)
+    folded_bias = _const_node(node.name + "/folded_bias", bias * scale + shift)
+
+    layer.input[1] = folded_kernel.name
+
+    node.op = "BiasAdd"
+    del node.input[:]
+    node.input.extend([layer.name, folded_bias.name])
+    node.ClearField("attr")
+    node.attr["T"].type = tf.float32.as_datatype_enum
+    if layer.op == "Conv2D":
+        node.attr["data_format"].s = layer.attr["data_format"].s
+
+    return [folded_kernel, folded_bias]
+
+## Try to fold a single node into the layer before it. Handles fused batch norm at inference and the mul and add a
+## non-fused batch norm turns into once its constants are folded.
+def _fold_node(nodes, consumers, node):
+    if node.op in ("FusedBatchNorm", "FusedBatchNormV2", "FusedBatchNormV3"):
+        if node.attr["is_training"].b:
+            return None
+
+        # only the normalized output can be used, the others are the batch statistics
+        if any([":" in input_name and not input_name.endswith(":0") for input_name in consumers[node.name]]):
+            return None
+
+        gamma, beta, mean, variance = [_const_value(nodes, name) for name in node.input[1:5]]
+        if any([value is None for value in (gamma, beta, mean, variance)]):
+            return None
+
+        scale = gamma / np.sqrt(variance + node.attr["epsilon"].f)
+
+        return _fold_into_layer(nodes, consumers, node, node.input[0], scale, beta - mean * scale)
+
+    if node.op in ("Mul", "Add", "AddV2"):
+        for x_name, const_name in (node.input[0], node.input[1]), (node.input[1], node.input[0]):
+            value = _const_value(nodes, const_name)
+            if value is None or value.ndim > 1:
+                continue
+
+            if node.op == "Mul":
+                return _fold_into_layer(nodes, consumers, node, x_name, value, 0.0)
+            else:
+                return _fold_into_layer(nodes, consumers, node, x_name, 1.0, value)
+
+    return None
+
+## Fold every batch norm that follows a conv or dense layer into that layer's kernel and bias. Returns the new graph
+## and the number of ops folded.
+def fold_batch_norms(graph_def):
+    folded_graph = tf.GraphDef()
+    folded_graph.CopyFrom(graph_def)
+    folded = 0
+
+    # fold one op at a time since each fold changes which nodes use which
+    while True:
+        nodes = {node.name: node for node in folded_graph.node}
+        consumers = _consumers(folded_graph)
+
+        for node in folded_graph.node:
+            new_nodes = _fold_node(nodes, consumers, node)
+            if new_nodes is not None:
+                folded_graph.node.extend(new_nodes)
+                folded += 1
+                break
+        else:
+            break
+
+    return folded_graph, folded
+
+## Export the forward path of a model to a frozen graph. The variables are converted to constants, everything not
+## needed to compute the outputs (the input pipeline, loss, optimizer, metrics and summaries) is stripped, constants
+## are folded and the batch norms are folded into the conv and dense layers before them.
+## The graph should be built with training as a constant False so the dropout and batch norm training branches are
+## never created.
+## Args: sess - session with the model restored
+##       path - where to write the graph
+##       input_names - names of the input placeholders
+##       output_names - names of the output ops
+## Returns: a dict with the number of nodes before and after and the number of batch norm ops folded
+def export_frozen_graph(sess, path, input_names, output_names):
+    graph_def = sess.graph.as_graph_def()
+    nodes_before = len(graph_def.node)
+
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+    graph_def = TransformGraph(graph_def, input_names, output_names,
+                               ["strip_unused_nodes", "remove_nodes(op=Identity, op=CheckNumerics)",
+                                "fold_constants(ignore_errors=true)"])
+
+    graph_def, folded = fold_batch_norms(graph_def)
+
+    # drop the unfolded weights and fold anything left over
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, output_names)
+    graph_def = TransformGraph(graph_def, input_names, output_names,
+                               ["fold_constants(ignore_errors=true)", "sort_by_execution_order"])
+
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    with tf.gfile.GFile(path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+
+    return {
+        "nodes_before": nodes_before,
+        "nodes_after": len(graph_def.node),
+        "batch_norms_folded": folded
+    }
+
+## Load a frozen graph into a new session.
+## Returns: the session, the input and output tensors and the time it took to load in milliseconds
+def load_frozen_graph(path, input_names, output_names, config=None):
+    start = time.time()
+
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+
+    inputs = [graph.get_tensor_by_name(name + ":0") for name in input_names]
+    outputs = [graph.get_tensor_by_name(name + ":0") for name in output_names]
+
+    sess = tf.Session(graph=graph, config=config)
+    load_ms = (time.time() - start) * 1000
+
+    return sess, inputs, outputs, load_ms
@@ -0,0 +1,276 @@
+import numpy as np
+import os
+import glob
+import collections
+import multiprocessing
+from PIL import Image
+import tensorflow as tf
+from training_utils import _finish_crop
+
+## decode a png into a uint8 array of shape (height, width, 3), channel 0 is the scan and channel 1 the mask
+def _decode_png(path):
+    image = np.asarray(Image.open(path), dtype=np.uint8)
+
+    # grayscale images have no channel axis, alpha channels are dropped
+    if image.ndim == 2:
+        image = np.stack([image, np.zeros_like(image), np.zeros_like(image)], axis=-1)
+
+    return image[:, :, :3]
+
+## Find where the tissue and the mask are in a png. Channel 0 is split into block_size x block_size blocks and a
+## block counts as tissue if its mean intensity is over the threshold. Returns the image shape, the coordinates of the
+## tissue blocks, the bounding box of the tissue and the bounding box of the mask (all -1 if there is no mask).
+def _image_regions(args):
+    path, block_size, tissue_threshold = args
+    image = _decode_png(path)
+    height, width = image.shape[0], image.shape[1]
+
+    # mean intensity of each block, the edges are trimmed to a whole number of blocks
+    rows, cols = height // block_size, width // block_size
+    blocks = image[:rows * block_size, :cols * block_size, 0].reshape(rows, block_size, cols, block_size)
+    tissue = np.argwhere(blocks.mean(axis=(1, 3)) > tissue_threshold).astype(np.int16)
+
+    if len(tissue):
+        tissue_box = [tissue[:, 0].min() * block_size, tissue[:, 1].min() * block_size,
+                      (tissue[:, 0].max() + 1) * block_size, (tissue[:, 1].max() + 1) * block_size]
+    else:
+        tissue_box = [-1, -1, -1, -1]
+
+    mask_rows = np.flatnonzero(image[:, :, 1].max(axis=1))
+    mask_cols = np.flatnonzero(image[:, :, 1].max(axis=0))
+    if len(mask_rows):
+        mask_box = [mask_rows[0], mask_cols[0], mask_rows[-1] + 1, mask_cols[-1] + 1]
+    else:
+        mask_box = [-1, -1, -1, -1]
+
+    return (height, width), tissue, tissue_box, mask_box
+
+## Build the index of tissue and mask regions for every png in a directory and save it next to the images as
+## roi_index.npz. The tissue blocks of all images are stored in one array with offsets into it.
+def build_roi_index(image_dir, block_size=64, tissue_threshold=20, num_workers=None):
+    files = sorted(glob.glob(os.path.join(image_dir, "*.png")))
+
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        regions = pool.map(_image_regions, [(path, block_size, tissue_threshold) for path in files], chunksize=4)
+    finally:
+        pool.terminate()
+
+    offsets = np.cumsum([0] + [len(tissue) for _, tissue, _, _ in regions])
+
+    np.savez(os.path.join(image_dir, "roi_index.npz"),
+             files=np.array([os.path.basename(path) for path in files]),
+             shapes=np.array([shape for shape, _, _, _ in regions], dtype=np.int32),
+             tissue_blocks=np.concatenate([tissue for _, tissue, _, _ in regions]).reshape(-1, 2),
+             tissue_offsets=offsets,
+             tissue_boxes=np.array([box for _, _, box, _ in regions], dtype=np.int32),
+             mask_boxes=np.array([box for _, _, _, box in regions], dtype=np.int32),
+             block_size=block_size,
+             tissue_threshold=tissue_threshold)
+
+## load the roi index for a directory of pngs, building it first if it doesn't exist or is missing any of the images
+def load_roi_index(image_dir, block_size=64, tissue_threshold=20):
+    index_path = os.path.join(image_dir, "roi_index.npz")
+    files = set(os.path.basename(path) for path in glob.glob(os.path.join(image_dir, "*.png")))
+
+    if os.path.exists(index_path):
+        index = np.load(index_path)
+        if files.issubset(set(index["files"])) and int(index["block_size"]) == block_size \
+                and int(index["tissue_threshold"]) == tissue_threshold:
+            return index
+
+    print("Building roi index for", image_dir)
+    build_roi_index(image_dir, block_size=block_size, tissue_threshold=tissue_threshold)
+
+    return np.load(index_path)
+
+## Chooses crop origins from the roi index instead of uniformly over the scan. A positive_ratio fraction of the crops
+## are centred on a random point of the mask's bounding box, the rest are centred on a random tissue block, so crops
+## of pure background are never drawn.
+class RoiCropSampler(object):
+    def __init__(self, index, positive_ratio=0.5, random=None):
+        self.positive_ratio = positive_ratio
+        self.random = random if random is not None else np.random.RandomState()
+
+        self.block_size = int(index["block_size"])
+        self.tissue_blocks = index["tissue_blocks"]
+        self.tissue_offsets = index["tissue_offsets"]
+        self.mask_boxes = index["mask_boxes"]
+        self.positions = {filename: i for i, filename in enumerate(index["files"])}
+
+    # pick the centre of the crop
+    def _centre(self, position):
+        mask_box = self.mask_boxes[position]
+        if mask_box[0] >= 0 and self.random.uniform() < self.positive_ratio:
+            return self.random.randint(mask_box[0], mask_box[2]), self.random.randint(mask_box[1], mask_box[3])
+
+        start, end = self.tissue_offsets[position], self.tissue_offsets[position + 1]
+        if end > start:
+            block = self.tissue_blocks[self.random.randint(start, end)]
+            return (block[0] * self.block_size + self.random.randint(self.block_size),
+                    block[1] * self.block_size + self.random.randint(self.block_size))
+
+        return None
+
+    # Returns the top left corner of a crop of size crop from an image, or None if the image isn't in the index or
+    # has no tissue, in which case the caller should fall back to a uniform crop
+    def origin(self, filename, height, width, crop):
+        position = self.positions.get(os.path.basename(filename))
+        if position is None:
+            return None
+
+        centre = self._centre(position)
+        if centre is None:
+            return None
+
+        # put the centre in the middle of the crop, keeping the crop inside the image
+        y = int(np.clip(centre[0] - crop // 2, 0, height - crop))
+        x = int(np.clip(centre[1] - crop // 2, 0, width - crop))
+
+        return y, x
+
+## Reads the full size training pngs for dataset 100 and serves random crops from them. The pngs are decoded in a pool
+## of worker processes and the decoded images are kept in an LRU cache keyed by filename, and several crops are taken
+## from each decoded image so a png is only decoded once for crops_per_image training examples.
+## If positive_ratio is set crops are drawn with a RoiCropSampler so they contain tissue, and that fraction of them
+## contain the mask where an image has one.
+## The worker processes are forked when the reader is created, so create it before starting a session.
+class PngTileReader(object):
+    def __init__(self, image_dir, crop_size, scale_by=0.66, crops_per_image=3, cache_size=64, num_workers=None, seed=None,
+                 positive_ratio=None, decode_ahead=None):
+        self.files = sorted(glob.glob(os.path.join(image_dir, "*.png")))
+        if not self.files:
+            raise ValueError("No png files found in " + image_dir)
+
+        self.crop_size = crop_size
+        self.scale_by = scale_by
+        self.crops_per_image = crops_per_image
+        self.cache_size = cache_size
+
+        # the number of images decoding in the pool at once, each is tens of MB so only a few are queued ahead
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+
+        self.decode_ahead = min(decode_ahead or 2 * num_workers, cache_size)
+
+        # figure out size of raw crop by dividing size by scale
+        if scale_by != 1.0:
+            self.image_size = int(crop_size // scale_by)
+        else:
+            self.image_size = crop_size
+
+        self.cache = collections.OrderedDict()
+        self.random = np.random.RandomState(seed)
+
+        # build the index before the pool is started since it uses its own
+        if positive_ratio is not None:
+            self.sampler = RoiCropSampler(load_roi_index(image_dir), positive_ratio=positive_ratio, random=self.random)
+        else:
+            self.sampler = None
+
+        self.pool = multiprocessing.Pool(num_workers)
+
+    # the number of crops served per pass over the images
+    @property
+    def records_per_epoch(self):
+        return len(self.files) * self.crops_per_image
+
+    # add an image to the cache, evicting the least recently used ones
+    def _cache_image(self, filename, image):
+        self.cache[filename] = image
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    # Yield each image in a shuffled order, decoding the ones not in the cache in the worker pool. Only decode_ahead
+    # of the coming misses are decoding at a time, the next is queued as each one is taken, so the decoded images
+    # waiting to be used never outgrow the window.
+    def _images(self):
+        order = [self.files[i] for i in self.random.permutation(len(self.files))]
+
+        pending = {}
+        next_queued = 0
+
+        for filename in order:
+            # top the window up with the coming images which aren't in the cache
+            while next_queued < len(order) and len(pending) < self.decode_ahead:
+                upcoming = order[next_queued]
+                next_queued += 1
+
+                if upcoming not in self.cache:
+                    pending[upcoming] = self.pool.apply_async(_decode_png, (upcoming,))
+
+            if filename in pending:
+                image = pending.pop(filename).get()
+                self._cache_image(filename, image)
+            elif filename in self.cache:
+                image = self.cache[filename]
+                self.cache.move_to_end(filename)
+            else:
+                # it was in the cache when it was passed over but has since been evicted
+                image = _decode_png(filename)
+                self._cache_image(filename, image)
+
+            yield filename, image
+
+    # take a random square crop with a small amount of noise in its size, the same as _process_images does
+    def _random_crop(self, filename, image):
+        height, width = image.shape[0], image.shape[1]
+
+        # without a resize the crop has to be exactly the crop size
+        if self.scale_by != 1.0:
+            crop = int(self.image_size * self.random.normal(1.0, 0.025))
+        else:
+            crop = self.image_size
+
+        crop = min(crop, height, width)
+
+        origin = None
+        if self.sampler is not None:
+            origin = self.sampler.origin(filename, height, width, crop)
+
+        if origin is not None:
+            y, x = origin
+        else:
+            y = self.random.randint(0, height - crop + 1)
+            x = self.random.randint(0, width - crop + 1)
+
+        return image[y:y + crop, x:x + crop, :]
+
+    # generator of raw crops, loops over the images forever
+    def crops(self):
+        while True:
+            for filename, image in self._images():
+                for _ in range(self.crops_per_image):
+                    yield self._random_crop(filename, image)
+
+    # Returns batches of scaled images and labels from the crops, the resize, channel split and scaling are done in
+    # the graph by _finish_crop. The iterator initializer is added to the 'iterator_initializers' collection.
+    def read_batches(self, batch_size, mu=127.0, scale=255.0, distort=False, standardize=False, shuffle_buffer=None,
+                     num_parallel_calls=6, prefetch=2):
+        # mix the crops from different images
+        if shuffle_buffer is None:
+            shuffle_buffer = 30 * batch_size
+
+        with tf.name_scope('png_pipeline'):
+            dataset = tf.data.Dataset.from_generator(self.crops, tf.uint8, tf.TensorShape([None, None, 3]))
+
+            dataset = dataset.map(lambda raw_image: _finish_crop(raw_image, crop_size=self.crop_size, scale_by=self.scale_by,
+                                                                 mu=mu, scale=scale, distort=distort,
+                                                                 standardize=standardize),
+                                  num_parallel_calls=num_parallel_calls)
+
+            dataset = dataset.shuffle(shuffle_buffer)
+            dataset = dataset.batch(batch_size)
+            dataset = dataset.prefetch(prefetch)
+
+            iterator = dataset.make_initializable_iterator()
+            tf.add_to_collection('iterator_initializers', iterator.initializer)
+
+            image, label = iterator.get_next()
+
+        return image, label
+
+    # shut down the worker pool
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,97 @@
+import numpy as np
+import time
+
+## the top left corners of tiles of size tile covering length pixels with at least overlap pixels of overlap
+def _tile_origins(length, tile, overlap):
+    if length <= tile:
+        return [0]
+
+    stride = tile - overlap
+    origins = list(range(0, length - tile, stride))
+
+    # the last tile is aligned with the edge of the image
+    origins.append(length - tile)
+
+    return origins
+
+## Blending weights for a tile - 1 in the interior and ramping down linearly over the overlap at the edges. The output
+## is divided by the summed weights, so pixels covered by a single tile get exactly that tile's output.
+def _blend_window(tile, overlap):
+    ramp = np.ones(tile, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+
+    return np.outer(ramp, ramp)
+
+## Predict a mask for a whole scan with a sliding window. The scan is tiled into tile x tile crops overlapping by
+## overlap pixels, the tiles are run through the graph batch_size at a time and the overlapping logits_sm outputs are
+## blended into a probability map the size of the scan. Tiles with no pixel at or over background_threshold are pure
+## background and aren't run through the graph, pixels only they cover are given a probability of 0 and pixels they
+## share with tiles that are run get those tiles' blended output. A tile with any tissue is run, so a thin band of
+## tissue along the skin line isn't missed.
+## Args: sess - session with the model restored
+##       X - input tensor of shape [None, tile, tile, 1]
+##       probabilities - output tensor of shape [None, tile, tile, 1], i.e. logits_sm
+##       scan - uint8 array of shape (height, width), the raw scan
+##       feed_dict - any other values to feed, e.g. {training: False}
+## Returns: the probability map of shape (height, width) and a dict of timing stats
+def predict_scan(sess, X, probabilities, scan, tile=640, overlap=160, batch_size=16, feed_dict=None,
+                 background_threshold=10, mu=127.0, scale=255.0):
+    if not 0 <= overlap < tile:
+        raise ValueError("overlap must be at least 0 and less than the tile size {}, got {}".format(tile, overlap))
+
+    start = time.time()
+    height, width = scan.shape[0], scan.shape[1]
+
+    # scans smaller than a tile are padded with black
+    padded_height, padded_width = max(height, tile), max(width, tile)
+    if padded_height != height or padded_width != width:
+        padded = np.zeros((padded_height, padded_width), dtype=scan.dtype)
+        padded[:height, :width] = scan
+        scan = padded
+
+    window = _blend_window(tile, overlap)
+    probability_sum = np.zeros((padded_height, padded_width), dtype=np.float32)
+    weight_sum = np.zeros((padded_height, padded_width), dtype=np.float32)
+
+    origins = [(y, x) for y in _tile_origins(padded_height, tile, overlap) for x in _tile_origins(padded_width, tile, overlap)]
+
+    # only the tiles that are run count towards the weights, so overlapping a skipped tile doesn't scale a tile down
+    tiles = [(y, x) for y, x in origins if scan[y:y + tile, x:x + tile].max() >= background_threshold]
+
+    feed = dict(feed_dict) if feed_dict is not None else {}
+    X_batch = np.empty((batch_size, tile, tile, 1), dtype=np.float32)
+
+    for i in range(0, len(tiles), batch_size):
+        batch_origins = tiles[i:i + batch_size]
+        n = len(batch_origins)
+
+        for j, (y, x) in enumerate(batch_origins):
+            X_batch[j, :, :, 0] = scan[y:y + tile, x:x + tile]
+
+        # scale the same way the validation data is
+        X_batch[:n] -= mu
+        X_batch[:n] /= scale
+
+        feed[X] = X_batch[:n]
+        batch_probabilities = sess.run(probabilities, feed_dict=feed)
+
+        for j, (y, x) in enumerate(batch_origins):
+            probability_sum[y:y + tile, x:x + tile] += batch_probabilities[j, :, :, 0] * window
+            weight_sum[y:y + tile, x:x + tile] += window
+
+    # pixels only covered by background tiles are 0
+    probability_map = np.divide(probability_sum, weight_sum, out=np.zeros_like(probability_sum), where=weight_sum > 0)
+    probability_map = probability_map[:height, :width]
+
+    elapsed = time.time() - start
+    stats = {
+        "tiles": len(origins),
+        "tiles_run": len(tiles),
+        "seconds": elapsed,
+        "megapixels_per_second": (height * width / 1e6) / elapsed
+    }
+
+    return probability_map, stats
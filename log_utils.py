@@ -0,0 +1,123 @@
+import os
+import time
+import sqlite3
+import numpy as np
+
+# the database the training metrics of every model are logged to
+METRICS_DB = os.path.join("data", "metrics.db")
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS metrics (
+    model TEXT NOT NULL,
+    run INTEGER NOT NULL,
+    epoch INTEGER,
+    step INTEGER,
+    metric TEXT NOT NULL,
+    value REAL,
+    time REAL NOT NULL
+)"""
+
+_INDEX = "CREATE INDEX IF NOT EXISTS metrics_model_metric ON metrics (model, metric)"
+
+# the history files the scripts used to rewrite every epoch, data/<model_name><metric>.npy
+_HISTORY_METRICS = ["train_acc", "cv_acc", "train_loss", "cv_loss", "train_recall", "cv_recall", "train_lr"]
+
+## open the metrics database, creating it if it doesn't exist
+def _connect(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # wait for other processes writing to the database rather than failing, and let them read while we write
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(_SCHEMA)
+    conn.execute(_INDEX)
+    conn.commit()
+
+    return conn
+
+## Append only log of a model's training metrics in a sqlite database shared by all the models. log() adds one row per
+## metric and commits straight away, so each epoch costs the same however long the history is and a crash never loses
+## the records before it. A restarted model carries on in a new run, and any .npy history files an older version of
+## the script wrote are imported as run 0 the first time the model is logged.
+class MetricsLog(object):
+    def __init__(self, model_name, path=METRICS_DB):
+        self.model_name = model_name
+        self.conn = _connect(path)
+
+        last_run = self.conn.execute("SELECT MAX(run) FROM metrics WHERE model = ?", (model_name,)).fetchone()[0]
+        if last_run is None:
+            last_run = self._import_history()
+
+        self.run = last_run + 1
+
+    # import the .npy history files of the model, returns the run they were imported as or -1 if there are none
+    def _import_history(self):
+        rows = []
+        for metric in _HISTORY_METRICS:
+            path = os.path.join("data", self.model_name + metric + ".npy")
+            if os.path.exists(path):
+                rows.extend([(self.model_name, 0, epoch, None, metric, float(value), os.path.getmtime(path))
+                             for epoch, value in enumerate(np.load(path))])
+
+        if not rows:
+            return -1
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+        return 0
+
+    # Log the metrics of an epoch, e.g. log(epoch, step, train_acc=0.9, cv_acc=0.85). Metrics which are None are
+    # skipped, the epoch can be None for metrics that are only tied to a step.
+    def log(self, epoch, step=None, **metrics):
+        now = time.time()
+        epoch = None if epoch is None else int(epoch)
+        step = None if step is None else int(step)
+        rows = [(self.model_name, self.run, epoch, step, metric, float(value), now)
+                for metric, value in sorted(metrics.items()) if value is not None]
+
+        with self.conn:
+            self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    # every value of a metric the model has logged, across all runs in the order they were logged
+    def history(self, metric):
+        rows = self.conn.execute("SELECT value FROM metrics WHERE model = ? AND metric = ? ORDER BY rowid",
+                                 (self.model_name, metric))
+
+        return [value for (value,) in rows]
+
+    def close(self):
+        self.conn.close()
+
+## Load a metric of some or all models from the log.
+## Returns: a dict of model name to a list of (run, epoch, step, value) in the order they were logged
+def load_metrics(metric, models=None, path=METRICS_DB):
+    conn = _connect(path)
+    query = "SELECT model, run, epoch, step, value FROM metrics WHERE metric = ?"
+    params = [metric]
+
+    if models is not None:
+        query += " AND model IN ({})".format(", ".join(["?"] * len(models)))
+        params.extend(models)
+
+    results = {}
+    for model, run, epoch, step, value in conn.execute(query + " ORDER BY rowid", params):
+        results.setdefault(model, []).append((run, epoch, step, value))
+
+    conn.close()
+
+    return results
+
+## Compare the models by the best value they reached of a metric, e.g. best_metrics("cv_recall").
+## Returns: a list of (model name, best value, epoch it was reached in) with the best model first
+def best_metrics(metric, lower_is_better=False, path=METRICS_DB):
+    conn = _connect(path)
+    best, order = ("MIN", "ASC") if lower_is_better else ("MAX", "DESC")
+
+    # sqlite returns the epoch of the row the MIN or MAX came from
+    rows = conn.execute("SELECT model, {}(value), epoch FROM metrics WHERE metric = ? GROUP BY model ORDER BY 2 {}"
+                        .format(best, order), (metric,)).fetchall()
+    conn.close()
+
+    return rows
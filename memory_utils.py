@@ -0,0 +1,71 @@
+import tensorflow as tf
+
+## Call fn(*inputs) without keeping its intermediate activations for the backward pass, they are recomputed from the
+## inputs when the gradients are computed instead, trading compute for memory. inputs must be tensors, fn can close
+## over others such as the training placeholder and can create variables, which are resource variables with the same
+## names they would otherwise have so checkpoints load either way. The batch norm moving average updates and the
+## regularization losses added while recomputing are dropped, so the moving averages are only updated once per step and
+## the l2 loss of the segment isn't counted twice by a loss built after the gradients.
+def recompute(fn, *inputs):
+    calls = []
+
+    def recomputable(*args):
+        collections = [tf.get_collection_ref(key) for key in (tf.GraphKeys.UPDATE_OPS, tf.GraphKeys.REGULARIZATION_LOSSES)]
+        sizes = [len(collection) for collection in collections]
+
+        # the gradients of functions with recomputed variables need resource variables
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            outputs = fn(*args)
+
+        # the first call is the forward pass, later ones are recomputing it for the gradients
+        if calls:
+            for collection, size in zip(collections, sizes):
+                del collection[size:]
+
+        calls.append(True)
+
+        return outputs
+
+    return tf.contrib.layers.recompute_grad(recomputable)(*inputs)
+
+## Build one segment of a model, fn(input) returns its output. input can be a tuple of tensors for a segment with
+## several inputs, e.g. a decoder with skip connections, which are passed to fn as separate arguments, and fn can
+## return a tuple of outputs. With recompute_activations set the activations inside the segment aren't kept for the
+## backward pass, only its inputs, and they are recomputed from them when its gradients are needed. A model of n layers
+## split into about sqrt(n) segments then keeps about 2 * sqrt(n) layers of activations at a time rather than n, for
+## about one more forward pass per step. Random ops in fn such as dropout need an op seed so the recomputation draws
+## the same values.
+def segment(fn, input, recompute_activations=False):
+    inputs = tuple(input) if isinstance(input, (list, tuple)) else (input,)
+
+    if not recompute_activations:
+        return fn(*inputs)
+
+    return recompute(fn, *inputs)
+
+## Accumulates the gradients of the loss over steps micro batches and applies their mean once, so training on batches
+## of steps * batch_size only needs the memory of one of batch_size. Run accumulate_op on every micro batch, along with
+## the batch norm update ops so their moving averages still update on each, and apply_op after every steps-th, which
+## applies the mean with the optimizer, increments global_step once and zeroes the sums. The sums are local variables
+## so they aren't checkpointed, and the local variables initializer zeroes them too.
+class GradientAccumulator(object):
+    def __init__(self, optimizer, loss, steps, global_step=None, var_list=None):
+        self.steps = steps
+
+        grads_and_vars = [(grad, var) for grad, var in optimizer.compute_gradients(loss, var_list=var_list)
+                          if grad is not None]
+
+        with tf.name_scope('accumulate_gradients'):
+            self.sums = [tf.Variable(tf.zeros(var.shape, dtype=var.dtype.base_dtype), trainable=False,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES], name="gradient_sum")
+                         for _, var in grads_and_vars]
+
+            self.accumulate_op = tf.group(*[total.assign_add(grad) for total, (grad, _) in zip(self.sums, grads_and_vars)])
+
+        # the mean of micro batches of the same size is the gradient of the whole batch
+        mean_grads_and_vars = [(total / float(steps), var) for total, (_, var) in zip(self.sums, grads_and_vars)]
+        apply_op = optimizer.apply_gradients(mean_grads_and_vars, global_step=global_step)
+
+        # only zero the sums once the optimizer has read them
+        with tf.control_dependencies([apply_op]):
+            self.apply_op = tf.group(*[total.assign(tf.zeros_like(total)) for total in self.sums])
@@ -0,0 +1,106 @@
+import tensorflow as tf
+from tensorboard import summary as summary_lib
+
+## create a float64 metric variable, these are local so tf.local_variables_initializer resets them like tf.metrics
+def _metric_variable(shape, name):
+    return tf.Variable(tf.zeros(shape, dtype=tf.float64), trainable=False, name=name,
+                       collections=[tf.GraphKeys.LOCAL_VARIABLES, tf.GraphKeys.METRIC_VARIABLES])
+
+## Turn histograms of the true and false examples by probability bin into confusion counts at every threshold. The
+## highest bin is last, so a reverse cumulative sum gives the number predicted positive at each threshold.
+## Returns: a [4, num_thresholds] tensor of tp, fp, tn, fn
+def _counts(true_predicted, false_predicted, total_true, total_false):
+    tp = tf.cumsum(true_predicted, reverse=True, axis=-1)
+    fp = tf.cumsum(false_predicted, reverse=True, axis=-1)
+
+    return tf.stack([tp, fp, total_false - fp, total_true - tp])
+
+## The index of the threshold closest to a decision threshold, for reading out metrics at an operating point
+def threshold_index(threshold, num_thresholds=100):
+    return min(max(int(round(threshold * num_thresholds)), 0), num_thresholds - 1)
+
+## Accumulate the per pixel and per image confusion matrix of a segmentation at num_thresholds evenly spaced
+## thresholds in one pass. Each pixel's probability is put in a bin and the batch is reduced to a histogram with a
+## single bincount, so the cost doesn't depend on the number of thresholds. Threshold k is k / num_thresholds, i.e.
+## a pixel is predicted positive at threshold k if its probability is >= k / num_thresholds.
+## An image is predicted positive if more than min_pixels of its pixels are, and is positive if any of its labels are.
+## Returns: the pixel and image counts, both [4, num_thresholds] tensors of tp, fp, tn, fn, and the update op
+def streaming_confusion(labels, probabilities, num_thresholds=100, min_pixels=0, updates_collections=None,
+                        name="confusion"):
+    with tf.name_scope(name):
+        pixel_counts = _metric_variable([4, num_thresholds], "pixel_counts")
+        image_counts = _metric_variable([4, num_thresholds], "image_counts")
+
+        batch_size = tf.shape(probabilities)[0]
+        probabilities = tf.reshape(probabilities, [batch_size, -1])
+        truth = tf.cast(tf.greater(tf.reshape(labels, [batch_size, -1]), 0), tf.int32)
+
+        # the probability bin of each pixel
+        bins = tf.clip_by_value(tf.cast(tf.floor(probabilities * num_thresholds), tf.int32), 0, num_thresholds - 1)
+
+        # histogram of the pixels by bin and label
+        pixel_histogram = tf.bincount(tf.reshape(bins * 2 + truth, [-1]), minlength=2 * num_thresholds,
+                                      maxlength=2 * num_thresholds)
+        pixel_histogram = tf.reshape(tf.cast(pixel_histogram, tf.float64), [num_thresholds, 2])
+
+        pixels_true = tf.reduce_sum(pixel_histogram[:, 1])
+        pixels_false = tf.reduce_sum(pixel_histogram[:, 0])
+        batch_pixel_counts = _counts(pixel_histogram[:, 1], pixel_histogram[:, 0], pixels_true, pixels_false)
+
+        # histogram of each image's pixels by bin, then the number predicted positive at each threshold
+        image_ids = tf.expand_dims(tf.range(batch_size), 1) * num_thresholds + bins
+        image_histogram = tf.bincount(tf.reshape(image_ids, [-1]), minlength=batch_size * num_thresholds,
+                                      maxlength=batch_size * num_thresholds)
+        image_positives = tf.cumsum(tf.reshape(image_histogram, [batch_size, num_thresholds]), reverse=True, axis=1)
+
+        image_predictions = tf.cast(tf.greater(image_positives, min_pixels), tf.float64)
+        image_truth = tf.cast(tf.reduce_max(truth, axis=1, keepdims=True), tf.float64)
+
+        images_true = tf.reduce_sum(image_truth)
+        images_false = tf.cast(batch_size, tf.float64) - images_true
+        tp = tf.reduce_sum(image_predictions * image_truth, axis=0)
+        fp = tf.reduce_sum(image_predictions * (1 - image_truth), axis=0)
+        batch_image_counts = tf.stack([tp, fp, images_false - fp, images_true - tp])
+
+        update_op = tf.group(tf.assign_add(pixel_counts, batch_pixel_counts),
+                             tf.assign_add(image_counts, batch_image_counts))
+
+        if updates_collections:
+            for collection in updates_collections:
+                tf.add_to_collection(collection, update_op)
+
+    return pixel_counts, image_counts, update_op
+
+## divide, giving 0 where the denominator is 0
+def _safe_divide(numerator, denominator):
+    return tf.where(tf.greater(denominator, 0), numerator / tf.maximum(denominator, 1e-12), tf.zeros_like(numerator))
+
+## Derive the metrics at every threshold from confusion counts. iou is the mean of the iou of each class, the same as
+## tf.metrics.mean_iou with 2 classes.
+## Returns: a dict of float32 tensors of shape [num_thresholds]
+def confusion_metrics(counts):
+    tp, fp, tn, fn = tf.unstack(counts)
+
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+
+    metrics = {
+        "accuracy": _safe_divide(tp + tn, tp + fp + tn + fn),
+        "precision": precision,
+        "recall": recall,
+        "specificity": _safe_divide(tn, tn + fp),
+        "f1": _safe_divide(2 * precision * recall, precision + recall),
+        "iou": (_safe_divide(tp, tp + fp + fn) + _safe_divide(tn, tn + fn + fp)) / 2
+    }
+
+    return {key: tf.cast(value, tf.float32) for key, value in metrics.items()}
+
+## a tensorboard pr curve built from confusion counts
+def pr_curve_summary(name, counts, collections=None):
+    tp, fp, tn, fn = tf.unstack(counts)
+    metrics = confusion_metrics(counts)
+
+    return summary_lib.pr_curve_raw_data_op(name, true_positive_counts=tp, false_positive_counts=fp,
+                                            true_negative_counts=tn, false_negative_counts=fn,
+                                            precision=metrics["precision"], recall=metrics["recall"],
+                                            num_thresholds=counts.shape[1].value, collections=collections)
@@ -3,8 +3,11 @@ import os
 import wget
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
+from profiling_utils import StepTracer
+from log_utils import MetricsLog
+from eval_utils import PredictionWriter
 from training_utils import download_file, get_batches, read_and_decode_single_example, load_validation_data, \
-    download_data, evaluate_model, get_training_data, load_weights, flatten, _scale_input_data
+    download_data, evaluate_model, get_training_data, load_weights, load_validation_filenames, _scale_input_data
 import argparse
 from tensorboard import summary as summary_lib
 
@@ -21,8 +24,11 @@ parser.add_argument("-c", "--contrast", help="contrast adjustment, if any", defa
 parser.add_argument("-w", "--weight", help="weight to give to positive examples in cross-entropy", default=2, type=int)
 parser.add_argument("-v", "--version", help="version or run number to assign to model name", default="")
 parser.add_argument("--distort", help="use online data augmentation", default=False, const=True, nargs="?")
+parser.add_argument("--trace", help="epochs:steps to trace, e.g. 0,-1:10-12 (none to turn off)", default="0,-1:10-12")
 args = parser.parse_args()
 
+trace_schedule = args.trace
+
 epochs = args.epochs
 dataset = args.data
 init_model = args.model
@@ -692,41 +698,8 @@ checkpoint_every = 1  # how often to save model in epochs
 use_gpu = False  # whether or not to use the GPU
 print_metrics = True  # whether to print or plot metrics, if False a plot will be created and updated every epoch
 
-# Initialize metrics or load them from disk if they exist
-if os.path.exists(os.path.join("data", model_name + "train_acc.npy")):
-    train_acc_values = np.load(os.path.join("data", model_name + "train_acc.npy")).tolist()
-else:
-    train_acc_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_loss.npy")):
-    train_cost_values = np.load(os.path.join("data", model_name + "train_loss.npy")).tolist()
-else:
-    train_cost_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_lr.npy")):
-    train_lr_values = np.load(os.path.join("data", model_name + "train_lr.npy")).tolist()
-else:
-    train_lr_values = []
-
-if os.path.exists(os.path.join("data", model_name + "train_recall.npy")):
-    train_recall_values = np.load(os.path.join("data", model_name + "train_recall.npy")).tolist()
-else:
-    train_recall_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_acc.npy")):
-    valid_acc_values = np.load(os.path.join("data", model_name + "cv_acc.npy")).tolist()
-else:
-    valid_acc_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_loss.npy")):
-    valid_cost_values = np.load(os.path.join("data", model_name + "cv_loss.npy")).tolist()
-else:
-    valid_cost_values = []
-
-if os.path.exists(os.path.join("data", model_name + "cv_recall.npy")):
-    valid_recall_values = np.load(os.path.join("data", model_name + "cv_recall.npy")).tolist()
-else:
-    valid_recall_values = []
+# log the metrics of each epoch, a restarted model carries on where its log left off
+metrics_log = MetricsLog(model_name)
 
 config = tf.ConfigProto()
 
@@ -780,6 +753,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
         print("Training model", model_name, "...")
 
+        # trace a few steps on a schedule, the rest run untraced
+        tracer = StepTracer(model_name, schedule=trace_schedule, epochs=epochs,
+                            writer=train_writer if log_to_tensorboard else None)
+
         for epoch in range(epochs):
             sess.run(tf.local_variables_initializer())
 
@@ -789,9 +766,8 @@ with tf.Session(graph=graph, config=config) as sess:
             batch_recall = []
 
             for i in range(steps_per_epoch):
-                # create the metadata
-                run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-                run_metadata = tf.RunMetadata()
+                # only trace the steps in the trace schedule
+                trace_options = tracer.run_options(epoch, i)
 
                 # Run training op and update ops
                 if (i % 50 != 0) or (i == 0):
@@ -802,8 +778,7 @@ with tf.Session(graph=graph, config=config) as sess:
                             feed_dict={
                                 training: True,
                             },
-                            options=run_options,
-                            run_metadata=run_metadata)
+                            **trace_options)
 
                         # write the summary
                         train_writer.add_summary(image_summary, step)
@@ -813,8 +788,7 @@ with tf.Session(graph=graph, config=config) as sess:
                                 feed_dict={
                                     training: True,
                                 },
-                                options=run_options,
-                                run_metadata=run_metadata)
+                                **trace_options)
 
                 # every 50th step get the metrics
                 else:
@@ -823,8 +797,7 @@ with tf.Session(graph=graph, config=config) as sess:
                         feed_dict={
                             training: True,
                         },
-                        options=run_options,
-                        run_metadata=run_metadata)
+                        **trace_options)
 
                     # Save accuracy (current batch)
                     batch_acc.append(acc_value)
@@ -836,9 +809,8 @@ with tf.Session(graph=graph, config=config) as sess:
                         # write the summary
                         train_writer.add_summary(summary, step)
 
-                # only log the meta data once per epoch
-                if i == 1:
-                    train_writer.add_run_metadata(run_metadata, 'step %d' % step)
+                # write the trace if this step was traced
+                tracer.record(epoch, i, step)
 
             # save checkpoint every nth epoch
             if (epoch % checkpoint_every == 0):
@@ -895,29 +867,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
             print("Done evaluating...")
 
-            # take the mean of the values to add to the metrics
-            valid_acc_values.append(np.mean(batch_cv_acc))
-            train_acc_values.append(np.mean(batch_acc))
-
-            valid_cost_values.append(np.mean(batch_cv_loss))
-            train_cost_values.append(np.mean(batch_cost))
-
-            valid_recall_values.append(np.mean(batch_cv_recall))
-            train_recall_values.append(np.mean(batch_recall))
-
-            train_lr_values.append(lr)
-
-            # save the metrics
-            np.save(os.path.join("data", model_name + "train_acc.npy"), train_acc_values)
-            np.save(os.path.join("data", model_name + "cv_acc.npy"), valid_acc_values)
-
-            np.save(os.path.join("data", model_name + "train_loss.npy"), train_cost_values)
-            np.save(os.path.join("data", model_name + "cv_loss.npy"), valid_cost_values)
-
-            np.save(os.path.join("data", model_name + "train_recall.npy"), train_recall_values)
-            np.save(os.path.join("data", model_name + "cv_recall.npy"), valid_recall_values)
-
-            np.save(os.path.join("data", model_name + "train_lr.npy"), train_lr_values)
+            # log the mean of the values for the epoch
+            metrics_log.log(epoch, step, train_acc=np.mean(batch_acc), cv_acc=np.mean(batch_cv_acc),
+                            train_loss=np.mean(batch_cost), cv_loss=np.mean(batch_cv_loss),
+                            train_recall=np.mean(batch_recall), cv_recall=np.mean(batch_cv_recall), train_lr=lr)
 
             # Print progress every nth epoch to keep output to reasonable amount
             if (epoch % print_every == 0):
@@ -948,10 +901,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
     test_accuracy = []
     test_recall = []
-    test_predictions = []
-    ground_truth = []
-    for X_batch, y_batch in get_batches(X_te, y_te, batch_size, distort=False):
-        _, yhat, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, accuracy, rec_op], feed_dict=
+    test_filenames = load_validation_filenames(data="test", which=dataset)
+    prediction_writer = PredictionWriter(model_name, "test", len(y_te))
+    for X_batch, y_batch, filenames_batch in get_batches(X_te, y_te, batch_size, filenames=test_filenames, distort=False):
+        _, yhat, probs, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, probabilities, accuracy, rec_op], feed_dict=
         {
             X: X_batch,
             y: y_batch,
@@ -960,8 +913,7 @@ with tf.Session(graph=graph, config=config) as sess:
 
         test_accuracy.append(test_acc_value)
         test_recall.append(test_recall_value)
-        test_predictions.append(yhat)
-        ground_truth.append(y_batch)
+        prediction_writer.add(yhat, y_batch, probabilities=probs, filenames=filenames_batch)
 
     print("Evaluating on MIAS data")
 
@@ -969,13 +921,8 @@ with tf.Session(graph=graph, config=config) as sess:
     print("Mean Test Accuracy:", np.mean(test_accuracy))
     print("Mean Test Recall:", np.mean(test_recall))
 
-    # unlist the predictions and truth
-    test_predictions = flatten(test_predictions)
-    ground_truth = flatten(ground_truth)
-
     # save the predictions and truth for review
-    np.save(os.path.join("data", "predictions_" + model_name + ".npy"), test_predictions)
-    np.save(os.path.join("data", "truth_" + model_name + ".npy"), ground_truth)
+    prediction_writer.close()
 
     sess.run(tf.local_variables_initializer())
 
@@ -984,10 +931,10 @@ with tf.Session(graph=graph, config=config) as sess:
 
     mias_test_accuracy = []
     mias_test_recall = []
-    mias_test_predictions = []
-    mias_ground_truth = []
-    for X_batch, y_batch in get_batches(X_te, y_te, batch_size, distort=False):
-        _, yhat, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, accuracy, rec_op], feed_dict=
+    mias_filenames = load_validation_filenames(data="mias", which=9)
+    mias_prediction_writer = PredictionWriter(model_name, "mias", len(y_te))
+    for X_batch, y_batch, filenames_batch in get_batches(X_te, y_te, batch_size, filenames=mias_filenames, distort=False):
+        _, yhat, probs, test_acc_value, test_recall_value = sess.run([extra_update_ops, predictions, probabilities, accuracy, rec_op], feed_dict=
         {
             X: X_batch,
             y: y_batch,
@@ -996,19 +943,13 @@ with tf.Session(graph=graph, config=config) as sess:
 
         mias_test_accuracy.append(test_acc_value)
         mias_test_recall.append(test_recall_value)
-        mias_test_predictions.append(yhat)
-        mias_ground_truth.append(y_batch)
+        mias_prediction_writer.add(yhat, y_batch, probabilities=probs, filenames=filenames_batch)
 
     # print the results
     print("Mean MIAS Accuracy:", np.mean(mias_test_accuracy))
     print("Mean MIAS Recall:", np.mean(mias_test_recall))
 
-    # unlist the predictions and truth
-    mias_test_predictions = flatten(mias_test_predictions)
-    mias_ground_truth = flatten(mias_ground_truth)
-
     # save the predictions and truth for review
-    np.save(os.path.join("data", "mias_predictions_" + model_name + ".npy"), mias_test_predictions)
-    np.save(os.path.join("data", "mias_truth_" + model_name + ".npy"), mias_ground_truth)
+    mias_prediction_writer.close()
 
 
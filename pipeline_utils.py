@@ -0,0 +1,187 @@
+import collections
+import numpy as np
+import tensorflow as tf
+
+# ops the training step blocks on until the input pipeline has a batch ready
+_INPUT_OPS = {"IteratorGetNext", "QueueDequeue", "QueueDequeueV2", "QueueDequeueMany", "QueueDequeueManyV2",
+              "QueueDequeueUpTo", "QueueDequeueUpToV2"}
+
+# the queues of the queue runner pipelines, string_input_producer, the shuffle queues, etc.
+_QUEUE_OPS = {"FIFOQueue", "FIFOQueueV2", "RandomShuffleQueue", "RandomShuffleQueueV2", "PaddingFIFOQueue",
+              "PaddingFIFOQueueV2"}
+
+## Create a stats aggregator for the stage latencies of a tf.data input pipeline. Its summary goes in the 'input_stats'
+## collection for the InputMonitor and in the summaries so merge_all picks it up. The pipeline has to be attached to
+## it with tf.contrib.data.set_stats_aggregator.
+def input_stats_aggregator():
+    aggregator = tf.contrib.data.StatsAggregator()
+    summary = aggregator.get_summary()
+
+    tf.add_to_collection('input_stats', summary)
+    tf.add_to_collection(tf.GraphKeys.SUMMARIES, summary)
+
+    return aggregator
+
+## Record the latency of the elements coming out of a stage of a tf.data pipeline, if there is a stats aggregator. The
+## latency of a stage includes the time spent in the stages before it, so the stages have to be added in pipeline
+## order, the order is kept in the 'input_stages' collection for the InputMonitor to take the differences.
+def stage_latency(dataset, stage, aggregator=None):
+    if aggregator is None:
+        return dataset
+
+    tag = "input_pipeline/" + stage
+    tf.add_to_collection('input_stages', tag)
+
+    return dataset.apply(tf.contrib.data.latency_stats(tag))
+
+## the fill level op and capacity of each queue in the graph
+def _queue_sizes(graph):
+    sizes = {}
+    for op in graph.get_operations():
+        if op.type in _QUEUE_OPS:
+            queue = tf.QueueBase(op.get_attr("component_types"), None, None, op.outputs[0])
+            sizes[op.name] = (queue.size(), op.get_attr("capacity"))
+
+    return sizes
+
+## the total and count of each latency histogram in a stats aggregator summary, in ms, since the pipeline started
+def _stage_latencies(serialized):
+    summary = tf.Summary.FromString(serialized)
+
+    return {value.tag: (value.histo.sum / 1000.0, value.histo.num)
+            for value in summary.value if value.HasField("histo")}
+
+## Shows whether training is waiting on the input pipeline. Every sample_every steps the step is run with a light trace
+## and the time spent in the ops that take the next batch (IteratorGetNext, queue dequeues), which only block when the
+## pipeline hasn't got one ready, is split from the rest of the step. The fill level of every queue and the stage
+## latencies of tf.data pipelines created with an input_stats_aggregator are sampled at the same time.
+## They are written to tensorboard as input/ scalars and end_epoch() prints a table for the epoch. The table shows the
+## time each tf.data stage adds to the ones before it, and for the queue runner pipelines, which have no latency stats,
+## which queues run nearly empty, i.e. which stages can't keep up.
+## Create it after the input pipeline, in the same graph.
+class InputMonitor(object):
+    def __init__(self, sample_every=50, writer=None):
+        self.sample_every = sample_every
+        self.writer = writer
+
+        graph = tf.get_default_graph()
+        self.queue_sizes = _queue_sizes(graph)
+        self.stats = graph.get_collection('input_stats')
+        self.stages = graph.get_collection('input_stages')
+
+        # the latency totals and counts at the start of the epoch, the aggregator's histograms cover the whole run
+        self.latency_start = {}
+        self.latency_totals = {}
+        self._reset()
+
+    def _reset(self):
+        self.step_times = []
+        self.wait_fractions = []
+        self.queue_fill = collections.defaultdict(list)
+        self.latency_start = dict(self.latency_totals)
+
+    # The options and metadata to pass to sess.run for a step, empty for the steps which aren't sampled. The samples
+    # are offset from the every 50th step the scripts fetch their summaries on so they time ordinary steps.
+    def run_options(self, step):
+        if (step + self.sample_every // 2) % self.sample_every != 0:
+            return {}
+
+        return {
+            "options": tf.RunOptions(trace_level=tf.RunOptions.SOFTWARE_TRACE),
+            "run_metadata": tf.RunMetadata()
+        }
+
+    # time the step spent waiting for its input in a trace, in seconds
+    def _input_wait(self, run_metadata):
+        waits = {}
+        for device in run_metadata.step_stats.dev_stats:
+            for node in device.node_stats:
+                # the label is "name = Op(inputs)"
+                label = node.timeline_label
+                op = label.split(" = ")[1].split("(")[0] if " = " in label else ""
+
+                if op in _INPUT_OPS:
+                    waits[node.node_name] = max(waits.get(node.node_name, 0), node.all_end_rel_micros)
+
+        return sum(waits.values()) / 1e6
+
+    # Record a step. step_time is the wall time of its sess.run in seconds, run_metadata is the metadata passed to it,
+    # if any, which can be from a StepTracer trace as well as from run_options.
+    def record(self, sess, step_time, run_metadata=None, global_step=None):
+        self.step_times.append(step_time)
+
+        if run_metadata is None or not run_metadata.step_stats.dev_stats:
+            return
+
+        wait = self._input_wait(run_metadata)
+        wait_fraction = min(wait / max(step_time, 1e-9), 1.0)
+        self.wait_fractions.append(wait_fraction)
+
+        scalars = {
+            "input/step_ms": step_time * 1000.0,
+            "input/wait_ms": wait * 1000.0,
+            "input/compute_ms": (step_time - wait) * 1000.0,
+            "input/wait_fraction": wait_fraction
+        }
+
+        if self.queue_sizes or self.stats:
+            sizes, stats = sess.run([{name: size for name, (size, _) in self.queue_sizes.items()}, self.stats])
+
+            for name, size in sizes.items():
+                capacity = self.queue_sizes[name][1]
+                fill = size / float(capacity) if capacity > 0 else float(size)
+
+                self.queue_fill[name].append(fill)
+                scalars["input/queue_fill/" + name] = fill
+
+            for serialized in stats:
+                self.latency_totals.update(_stage_latencies(serialized))
+
+        if self.writer is not None and global_step is not None:
+            summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value) for tag, value in scalars.items()])
+            self.writer.add_summary(summary, global_step)
+
+    # the mean latency of each stage over the epoch in pipeline order, in ms, for the stages with elements this epoch
+    def _epoch_latencies(self):
+        latencies = []
+        for tag in self.stages:
+            total, count = self.latency_totals.get(tag, (0.0, 0))
+            start_total, start_count = self.latency_start.get(tag, (0.0, 0))
+
+            if count > start_count:
+                latencies.append((tag, (total - start_total) / (count - start_count)))
+
+        return latencies
+
+    # print the table for the epoch and start the next one
+    def end_epoch(self, epoch):
+        if not self.step_times:
+            return
+
+        step_ms = np.mean(self.step_times) * 1000.0
+        wait_fraction = np.mean(self.wait_fractions) if self.wait_fractions else 0.0
+
+        print("Input pipeline - epoch {:02d}".format(epoch))
+        print("    step\t\t{:.1f} ms".format(step_ms))
+        print("    waiting for input\t{:.1f} ms ({:.1f}%)".format(step_ms * wait_fraction, 100 * wait_fraction))
+        print("    compute\t\t{:.1f} ms".format(step_ms * (1 - wait_fraction)))
+
+        # a queue that is nearly empty is waiting on the stages that fill it
+        for name, fills in sorted(self.queue_fill.items()):
+            print("    queue {}\t{:.1f}% full (mean), {:.1f}% (min){}".format(
+                name, 100 * np.mean(fills), 100 * np.min(fills), " - starved" if np.mean(fills) < 0.1 else ""))
+
+        # the latency of each stage includes the stages before it, so the time a stage adds is the difference from the
+        # previous one. A stage that buffers, like prefetch, hides the time before it and adds a negative time.
+        previous = 0.0
+        for tag, latency in self._epoch_latencies():
+            print("    {}\t{:+.2f} ms per element ({:.2f} ms up to here)".format(tag, latency - previous, latency))
+            previous = latency
+
+        # a step that mostly waits for input needs a faster pipeline, otherwise the model is the limit
+        if wait_fraction > 0.2:
+            print("    input bound - add reader threads or cache the decoded tiles")
+        else:
+            print("    compute bound")
+
+        self._reset()
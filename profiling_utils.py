@@ -0,0 +1,98 @@
+import os
+import collections
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+## Parse a trace schedule of the form "epochs:steps", e.g. "0,-1:10-12" traces steps 10 to 12 of the first and last
+## epochs. Negative epochs count back from the last one. "none" or an empty string turns tracing off.
+## Returns: a set of epochs and a set of steps
+def parse_trace_schedule(schedule, epochs=None):
+    if not schedule or schedule.lower() == "none":
+        return set(), set()
+
+    epoch_spec, step_spec = schedule.split(":")
+
+    trace_epochs = set()
+    for epoch in epoch_spec.split(","):
+        epoch = int(epoch)
+        if epoch < 0:
+            if epochs is None:
+                raise ValueError("Negative epochs in a trace schedule need the number of epochs")
+            epoch += epochs
+
+        trace_epochs.add(epoch)
+
+    trace_steps = set()
+    for steps in step_spec.split(","):
+        if "-" in steps:
+            first, last = steps.split("-")
+            trace_steps.update(range(int(first), int(last) + 1))
+        else:
+            trace_steps.add(int(steps))
+
+    return trace_epochs, trace_steps
+
+## Traces a few training steps on a schedule instead of every step. run_options() gives the extra arguments for
+## sess.run, which are empty for untraced steps so they run at full speed, and record() writes the trace of a traced
+## step to log_dir as a chrome trace (open in chrome://tracing) and a table of time per op type.
+class StepTracer(object):
+    def __init__(self, model_name, schedule="0,-1:10-12", epochs=None, log_dir="./logs", writer=None):
+        self.model_name = model_name
+        self.epochs, self.steps = parse_trace_schedule(schedule, epochs)
+        self.log_dir = log_dir
+        self.writer = writer
+        self.run_metadata = None
+
+    # the options and metadata to pass to sess.run for a step
+    def run_options(self, epoch, step):
+        if epoch not in self.epochs or step not in self.steps:
+            self.run_metadata = None
+            return {}
+
+        self.run_metadata = tf.RunMetadata()
+
+        return {
+            "options": tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            "run_metadata": self.run_metadata
+        }
+
+    # total time and count of each op type in a trace, sorted by time
+    def _op_times(self):
+        op_times = collections.defaultdict(lambda: [0, 0])
+        for device in self.run_metadata.step_stats.dev_stats:
+            for node in device.node_stats:
+                # the label is "name = Op(inputs)"
+                label = node.timeline_label
+                op = label.split(" = ")[1].split("(")[0] if " = " in label else node.node_name
+
+                op_times[op][0] += node.all_end_rel_micros
+                op_times[op][1] += 1
+
+        return sorted(op_times.items(), key=lambda item: item[1][0], reverse=True)
+
+    # write the trace of the last step if it was traced
+    def record(self, epoch, step, global_step=None):
+        if self.run_metadata is None:
+            return
+
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        name = "{}_e{}_s{}".format(self.model_name, epoch, step)
+
+        trace = timeline.Timeline(self.run_metadata.step_stats)
+        with open(os.path.join(self.log_dir, "timeline_" + name + ".json"), "w") as f:
+            f.write(trace.generate_chrome_trace_format())
+
+        op_times = self._op_times()
+        total = sum([micros for _, (micros, _) in op_times])
+
+        with open(os.path.join(self.log_dir, "ops_" + name + ".txt"), "w") as f:
+            f.write("op\tcount\tms\tpercent\n")
+            for op, (micros, count) in op_times:
+                f.write("{}\t{}\t{:.3f}\t{:.1f}\n".format(op, count, micros / 1000.0, 100.0 * micros / max(total, 1)))
+
+        if self.writer is not None:
+            self.writer.add_run_metadata(self.run_metadata, 'step %d' % (global_step if global_step is not None else step))
+
+        self.run_metadata = None
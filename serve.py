@@ -0,0 +1,118 @@
+import numpy as np
+import tensorflow as tf
+import io
+import json
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+from export_utils import load_frozen_graph
+from serving_utils import MicroBatcher
+
+## Serves an exported model (see -a export in the candidate scripts) over http on the local machine.
+##   POST /predict - body is a png or raw uint8 tiles (Content-Type: application/octet-stream) of size x size pixels,
+##                   several raw tiles can be sent back to back. Channel 0 of a png is the scan.
+##                   Add ?output=mask for a uint8 mask instead of float16 probabilities.
+##                   The result is returned as a .npy file of shape (tiles, size, size).
+##   GET /metrics  - request latency percentiles and batch fill as json
+parser = argparse.ArgumentParser()
+parser.add_argument("-m", "--model", help="name of the exported model in ./model or path to a .pb", required=True)
+parser.add_argument("--host", help="address to listen on", default="127.0.0.1")
+parser.add_argument("-p", "--port", help="port to listen on", default=8000, type=int)
+parser.add_argument("-b", "--batch", help="maximum number of tiles in a batch", default=16, type=int)
+parser.add_argument("--latency", help="milliseconds to wait for a batch to fill", default=10.0, type=float)
+parser.add_argument("-t", "--threshold", help="decision threshold for masks", default=0.5, type=float)
+parser.add_argument("--input", help="name of the input placeholder", default="inputs/X")
+parser.add_argument("--output", help="name of the output op", default="logits_sm")
+args = parser.parse_args()
+
+model_path = args.model if args.model.endswith(".pb") else './model/' + args.model + '.pb'
+
+sess, inputs, outputs, load_ms = load_frozen_graph(model_path, input_names=[args.input], output_names=[args.output])
+print("Loaded", model_path, "in {:.1f} ms".format(load_ms))
+
+batcher = MicroBatcher(sess, inputs[0], outputs[0], max_batch_size=args.batch, max_latency_ms=args.latency)
+size = batcher.size
+
+batcher.warm_up()
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    def _respond(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, code, message):
+        self._respond(code, json.dumps({"error": message}).encode("utf-8"), "application/json")
+
+    # decode the request body into uint8 tiles of shape (n, size, size)
+    def _read_tiles(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.headers.get("Content-Type") == "application/octet-stream":
+            if len(body) == 0 or len(body) % (size * size) != 0:
+                raise ValueError("Raw tiles must be {0}x{0} uint8".format(size))
+
+            return np.frombuffer(body, dtype=np.uint8).reshape(-1, size, size)
+
+        image = np.asarray(Image.open(io.BytesIO(body)), dtype=np.uint8)
+        if image.ndim == 3:
+            image = image[:, :, 0]
+
+        return image[np.newaxis]
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/metrics":
+            return self._error(404, "Not found")
+
+        metrics = batcher.stats.summary()
+        metrics["model"] = model_path
+        metrics["load_ms"] = load_ms
+        metrics["max_batch_size"] = args.batch
+
+        self._respond(200, json.dumps(metrics).encode("utf-8"), "application/json")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            return self._error(404, "Not found")
+
+        try:
+            tiles = self._read_tiles()
+            probabilities = batcher.predict(tiles)
+        except (ValueError, IOError) as e:
+            return self._error(400, str(e))
+        except tf.errors.OpError as e:
+            # the graph failed on the batch, e.g. tiles of the wrong shape
+            return self._error(500, e.message)
+
+        if parse_qs(url.query).get("output", ["probabilities"])[0] == "mask":
+            result = (probabilities >= args.threshold).astype(np.uint8)
+        else:
+            result = probabilities.astype(np.float16)
+
+        out = io.BytesIO()
+        np.save(out, result)
+        self._respond(200, out.getvalue(), "application/octet-stream")
+
+    # keep the request log quiet, the metrics endpoint has the latencies
+    def log_message(self, format, *args):
+        pass
+
+# each request gets its own thread so concurrent requests can be batched together
+class ScoringServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+server = ScoringServer((args.host, args.port), ScoringHandler)
+print("Serving {}x{} tiles on http://{}:{}".format(size, size, args.host, args.port))
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    sess.close()
@@ -0,0 +1,159 @@
+import numpy as np
+import time
+import threading
+import collections
+import queue
+
+## Keeps the latencies of the most recent requests and the fill of the most recent batches so percentiles can be
+## reported without the memory growing while the server runs.
+class ServingStats(object):
+    def __init__(self, window=10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_fills = collections.deque(maxlen=window)
+        self.requests = 0
+        self.tiles = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def add_request(self, latency_ms, tiles):
+        with self.lock:
+            self.latencies.append(latency_ms)
+            self.requests += 1
+            self.tiles += tiles
+
+    def add_batch(self, fill):
+        with self.lock:
+            self.batch_fills.append(fill)
+            self.batches += 1
+
+    # a snapshot of the stats as a dict
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float32)
+            fills = np.array(self.batch_fills, dtype=np.float32)
+
+            return {
+                "requests": self.requests,
+                "tiles": self.tiles,
+                "batches": self.batches,
+                "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+                "mean_batch_fill": float(fills.mean()) if len(fills) else None
+            }
+
+# a queued request, done is set once probabilities has been filled in
+class _Request(object):
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.probabilities = None
+        self.error = None
+        self.done = threading.Event()
+        self.start = time.time()
+
+## Coalesces concurrent requests into micro-batches for a loaded model. Requests are queued and a single worker thread
+## runs them through the graph, waiting up to max_latency_ms after the first request of a batch for more requests to
+## fill it up to max_batch_size tiles. Only the worker thread uses the session.
+## Args: sess - session with the model loaded, e.g. from load_frozen_graph
+##       X - input tensor of shape [None, size, size, 1]
+##       probabilities - output tensor of shape [None, size, size, 1]
+class MicroBatcher(object):
+    def __init__(self, sess, X, probabilities, max_batch_size=16, max_latency_ms=10.0, mu=127.0, scale=255.0):
+        self.sess = sess
+        self.X = X
+        self.probabilities = probabilities
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.mu = mu
+        self.scale = scale
+        self.size = int(X.shape[1])
+
+        self.stats = ServingStats()
+        self.requests = queue.Queue()
+        self.X_batch = np.empty((max_batch_size, self.size, self.size, 1), dtype=np.float32)
+
+        self.worker = threading.Thread(target=self._run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    # Score uint8 tiles of shape (n, size, size), blocking until they have been run.
+    # Returns: float32 probabilities of shape (n, size, size)
+    def predict(self, tiles):
+        tiles = np.asarray(tiles, dtype=np.uint8)
+        if tiles.ndim == 2:
+            tiles = tiles[np.newaxis]
+
+        if tiles.shape[1:] != (self.size, self.size):
+            raise ValueError("Tiles must be {0}x{0}".format(self.size))
+
+        request = _Request(tiles)
+        self.requests.put(request)
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        self.stats.add_request((time.time() - request.start) * 1000, len(tiles))
+
+        return request.probabilities
+
+    # Run one batch so the first request doesn't pay for the graph warming up, and leave it out of the stats so it
+    # doesn't skew the latency percentiles. Call it before serving any requests.
+    def warm_up(self):
+        self.predict(np.zeros((1, self.size, self.size), dtype=np.uint8))
+        self.stats = ServingStats()
+
+    # wait for the first request, then gather more until the batch is full or the latency budget is used up
+    def _gather(self):
+        batch = [self.requests.get()]
+        tiles = len(batch[0].tiles)
+        deadline = time.time() + self.max_latency
+
+        while tiles < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                request = self.requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            batch.append(request)
+            tiles += len(request.tiles)
+
+        return batch
+
+    # run the tiles of a batch of requests through the graph max_batch_size tiles at a time
+    def _score(self, batch):
+        tiles = np.concatenate([request.tiles for request in batch])
+        probabilities = np.empty(tiles.shape, dtype=np.float32)
+
+        for i in range(0, len(tiles), self.max_batch_size):
+            n = min(self.max_batch_size, len(tiles) - i)
+
+            # scale the same way the validation data is
+            self.X_batch[:n, :, :, 0] = tiles[i:i + n]
+            self.X_batch[:n] -= self.mu
+            self.X_batch[:n] /= self.scale
+
+            probabilities[i:i + n] = self.sess.run(self.probabilities, feed_dict={self.X: self.X_batch[:n]})[:, :, :, 0]
+            self.stats.add_batch(n / self.max_batch_size)
+
+        # hand each request back its own tiles
+        offset = 0
+        for request in batch:
+            request.probabilities = probabilities[offset:offset + len(request.tiles)]
+            offset += len(request.tiles)
+
+    def _run(self):
+        while True:
+            batch = self._gather()
+
+            try:
+                self._score(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+
+            for request in batch:
+                request.done.set()
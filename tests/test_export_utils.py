@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+tf = pytest.importorskip("tensorflow")
+
+from export_utils import fold_batch_norms
+
+
+# a dense layer followed by the mul and add a non-fused batch norm becomes once its constants are folded
+def _dense_mul_add_graph(kernel, scale, shift):
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=[None, kernel.shape[0]], name="x")
+        y = tf.matmul(x, tf.constant(kernel, name="kernel"), name="dense")
+        y = tf.multiply(y, tf.constant(scale, name="scale"), name="bn_mul")
+        tf.add(y, tf.constant(shift, name="shift"), name="bn_add")
+
+    return graph.as_graph_def()
+
+
+# run a graph def on x and return the output of bn_add
+def _run(graph_def, x):
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+
+    with tf.Session(graph=graph) as sess:
+        return sess.run("bn_add:0", feed_dict={"x:0": x})
+
+
+def test_fold_mul_and_add_into_dense_layer():
+    rng = np.random.RandomState(0)
+    kernel = rng.randn(3, 2).astype(np.float32)
+    scale = rng.rand(2).astype(np.float32) + 0.5
+    shift = rng.randn(2).astype(np.float32)
+    x = rng.randn(4, 3).astype(np.float32)
+
+    graph_def = _dense_mul_add_graph(kernel, scale, shift)
+    folded_graph, folded = fold_batch_norms(graph_def)
+
+    assert folded == 2
+
+    names = [node.name for node in folded_graph.node]
+    assert len(names) == len(set(names))
+
+    # the graph still imports and computes the same output
+    assert np.allclose(_run(folded_graph, x), _run(graph_def, x), atol=1e-5)
+
+    # the output is a single bias add of the dense layer
+    nodes = {node.name: node for node in folded_graph.node}
+    assert nodes["bn_add"].op == "BiasAdd"
+    assert nodes["bn_add"].input[0] == "dense"
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inference_utils import predict_scan, _tile_origins
+
+
+# a stub session whose model outputs the same probability for every pixel
+class ConstantSession(object):
+    def __init__(self, value):
+        self.value = value
+
+    def run(self, fetches, feed_dict=None):
+        return np.full(feed_dict["X"].shape, self.value, dtype=np.float32)
+
+
+# the pixels covered by the tiles that have any pixel over the threshold
+def _covered(scan, tile, overlap, threshold=10):
+    covered = np.zeros(scan.shape, dtype=bool)
+    for y in _tile_origins(scan.shape[0], tile, overlap):
+        for x in _tile_origins(scan.shape[1], tile, overlap):
+            if scan[y:y + tile, x:x + tile].max() >= threshold:
+                covered[y:y + tile, x:x + tile] = True
+
+    return covered
+
+
+def test_constant_blend_across_skipped_tiles():
+    # tissue on the left, background on the right so the last column of tiles is skipped
+    scan = np.zeros((160, 160), dtype=np.uint8)
+    scan[:, :90] = 200
+
+    probability_map, stats = predict_scan(ConstantSession(0.75), "X", "probabilities", scan, tile=64, overlap=16,
+                                          batch_size=4)
+
+    assert stats["tiles_run"] < stats["tiles"]
+
+    covered = _covered(scan, 64, 16)
+    assert np.allclose(probability_map[covered], 0.75)
+    assert np.all(probability_map[~covered] == 0)
+
+
+def test_tile_with_a_thin_band_of_tissue_is_run():
+    # a band of tissue 2 pixels wide, the tiles it reaches are mostly background
+    scan = np.zeros((160, 160), dtype=np.uint8)
+    scan[:, :2] = 200
+
+    probability_map, stats = predict_scan(ConstantSession(0.5), "X", "probabilities", scan, tile=64, overlap=16,
+                                          batch_size=4)
+
+    assert scan[:64, :64].mean() < 10
+    # the first column of tiles is run, the rest are empty
+    assert stats["tiles_run"] == len(_tile_origins(160, 64, 16))
+    assert np.allclose(probability_map[:, :2], 0.5)
+    assert np.allclose(probability_map[:, :64], 0.5)
+    assert np.all(probability_map[:, 64:] == 0)
+
+
+@pytest.mark.parametrize("overlap", [-1, 64, 80])
+def test_overlap_must_be_less_than_the_tile(overlap):
+    scan = np.full((160, 160), 200, dtype=np.uint8)
+
+    with pytest.raises(ValueError):
+        predict_scan(ConstantSession(0.5), "X", "probabilities", scan, tile=64, overlap=overlap)
@@ -0,0 +1,821 @@
+import numpy as np
+import os
+import sys
+import time
+import glob
+import argparse
+import subprocess
+import tensorflow as tf
+from training_utils import get_training_data, load_weights, augment, open_validation_data, read_and_decode_dataset, \
+    annealed_ratio, abnormal_ratio_variable, abnormal_fraction
+from image_utils import PngTileReader, _decode_png
+from inference_utils import predict_scan
+from export_utils import export_frozen_graph, load_frozen_graph
+from profiling_utils import StepTracer
+from checkpoint_utils import AsyncCheckpointer, latest_checkpoint, update_best
+from metrics_utils import streaming_confusion, confusion_metrics, threshold_index, pr_curve_summary
+from eval_utils import ProbabilityWriter, sweep_model, print_sweep
+from log_utils import MetricsLog
+from pipeline_utils import InputMonitor
+from memory_utils import GradientAccumulator
+
+## The settings shared by the segmentation models. A script's config overrides these and the command line overrides
+## the script's config. Anything else a model builder needs, e.g. its regularization and dropout rates, goes in the
+## script's config too.
+DEFAULT_CONFIG = {
+    # run
+    "name": None,
+    "epochs": 30,
+    "dataset": 12,
+    "init_model": None,
+    "restore_model": None,
+    "how": "mask",
+    "action": "train",
+    "version": "",
+    "threshold": 0.5,
+    "metric_thresholds": 100,
+    "sweep_thresholds": 200,
+    "scan_path": None,
+    "trace_schedule": "0,-1:10-12",
+    "monitor_every": 50,
+
+    # input
+    "batch_size": 16,
+    "size": 640,
+    # the size of the tiles in the tfrecords, and how much the full images are scaled before cropping with dataset 100
+    "record_size": 640,
+    "scale_by": 0.66,
+    "normalize": False,
+    "distort": False,
+    "rotate": False,
+    "max_rotation": 0.0,
+    "contrast": None,
+    "cache_dir": None,
+    "positive_ratio": None,
+    # the number of random crops taken from each full image per epoch with dataset 100
+    "crops_per_image": 3,
+    "abnormal_ratio": None,
+    "abnormal_ratio_end": None,
+
+    # model output - "sigmoid" for logits with one channel, "softmax" for logits with num_classes channels of which
+    # channel 1 is the mask
+    "output": "sigmoid",
+    "num_classes": 2,
+
+    # loss - "iou", or half iou and half x-entropy with xe_loss set, or "xe" for weighted x-entropy
+    "loss": "iou",
+    "weight": 15,
+    "xe_loss": False,
+
+    # learning rate
+    "starting_rate": 0.001,
+    "retrain_rate": 0.0001,
+    "epochs_per_decay": 15,
+    "decay_factor": 0.85,
+    "staircase": True,
+
+    # memory - recompute the activations inside the model's segments on the backward pass, see memory_utils.segment,
+    # and apply the gradients of accumulate_steps batches at once, an effective batch of batch_size * accumulate_steps
+    "recompute": False,
+    "accumulate_steps": 1,
+
+    # freezing layers - only variables in these scopes are trained when freeze is set
+    "freeze": False,
+    "stop": False,
+    "freeze_scopes": ["up_conv", "fc", "bottleneck", "logits", "upsample", "conv5"],
+
+    # the scopes not to load when initializing the weights from another model with -m
+    "init_exclude": [],
+
+    # logging
+    "log_to_tensorboard": True,
+    "print_every": 1,
+    "checkpoint_every": 1,
+    "keep_checkpoints": 3,
+
+    # evaluation - None to validate in the training loop, "cpu" or "gpu" to validate in a separate process
+    "evaluator": None,
+    "eval_poll_seconds": 30,
+}
+
+## Parse the command line arguments every segmentation script takes, using the script's config as the defaults.
+## Returns: the config with the arguments applied
+def parse_args(config):
+    config = dict(DEFAULT_CONFIG, **config)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--epochs", help="number of epochs to train", default=config["epochs"], type=int)
+    parser.add_argument("-d", "--data", help="which dataset to use", default=config["dataset"], type=int)
+    parser.add_argument("-m", "--model", help="model to initialize weights with", default=config["init_model"])
+    parser.add_argument("-r", "--restore", help="model to restore and continue training", default=config["restore_model"])
+    parser.add_argument("-l", "--label", help="how to classify data", default=config["how"])
+    parser.add_argument("-a", "--action", help="action to perform (train, test, sweep, predict or export)",
+                        default=config["action"])
+    parser.add_argument("-f", "--freeze", help="whether to freeze convolutional layers", nargs='?', const=True,
+                        default=config["freeze"])
+    parser.add_argument("-s", "--stop", help="stop gradient at pool5", nargs='?', const=True, default=config["stop"])
+    parser.add_argument("-t", "--threshold", help="decision threshold", default=config["threshold"], type=float)
+    parser.add_argument("-c", "--contrast", help="contrast adjustment, if any", default=config["contrast"], type=float)
+    parser.add_argument("-n", "--normalize", help="apply per image normalization", nargs='?', const=True,
+                        default=config["normalize"])
+    parser.add_argument("-w", "--weight", help="weight to give to positive examples in cross-entropy",
+                        default=config["weight"], type=float)
+    parser.add_argument("-v", "--version", help="version or run number to assign to model name", default=config["version"])
+    parser.add_argument("--distort", help="use online data augmentation", default=config["distort"], const=True, nargs="?")
+    parser.add_argument("--size", help="size of image to crop (default 640)", default=config["size"], type=int)
+    parser.add_argument("-i", "--iou", help="DO NOT use iou loss, use x-entropy instead", nargs='?', const=True,
+                        default=config["xe_loss"])
+    parser.add_argument("--loss", help="loss to train with, iou or xe", choices=["iou", "xe"], default=config["loss"])
+    parser.add_argument("--cache", help="directory to cache decoded training tiles in", default=config["cache_dir"])
+    parser.add_argument("--scan", help="png or directory of pngs to predict masks for with -a predict",
+                        default=config["scan_path"])
+    parser.add_argument("--roi", help="fraction of full image crops to take from the mask, the rest are taken from tissue",
+                        default=config["positive_ratio"], type=float)
+    parser.add_argument("--crops", help="number of random crops to take from each full image per epoch with -d 100",
+                        default=config["crops_per_image"], type=int)
+    parser.add_argument("--balance", help="fraction of each batch to sample from abnormal tiles, optionally followed by "
+                        "the fraction to anneal it to by the last epoch", nargs="+", type=float, default=None)
+    parser.add_argument("--recompute", help="recompute activations on the backward pass to train larger crops or batches",
+                        nargs='?', const=True, default=config["recompute"])
+    parser.add_argument("--accumulate", help="number of batches to accumulate the gradients of before each update",
+                        default=config["accumulate_steps"], type=int)
+    parser.add_argument("--trace", help="epochs:steps to trace, e.g. 0,-1:10-12 (none to turn off)",
+                        default=config["trace_schedule"])
+    parser.add_argument("--evaluator", help="validate the checkpoints in a separate process on the cpu (default) or gpu",
+                        nargs='?', const="cpu", default=config["evaluator"])
+    args = parser.parse_args()
+
+    if args.balance is not None:
+        config["abnormal_ratio"] = args.balance[0]
+        config["abnormal_ratio_end"] = args.balance[1] if len(args.balance) > 1 else None
+
+    config.update({
+        "epochs": args.epochs,
+        "dataset": args.data,
+        "init_model": args.model,
+        "restore_model": args.restore,
+        "how": args.label,
+        "action": args.action,
+        "freeze": args.freeze,
+        "stop": args.stop,
+        "threshold": args.threshold,
+        "contrast": args.contrast,
+        "normalize": args.normalize,
+        "weight": args.weight,
+        "version": args.version,
+        "distort": args.distort,
+        "size": args.size,
+        "xe_loss": args.iou,
+        "loss": args.loss,
+        "cache_dir": args.cache,
+        "scan_path": args.scan,
+        "positive_ratio": args.roi,
+        "crops_per_image": args.crops,
+        "trace_schedule": args.trace,
+        "recompute": args.recompute,
+        "accumulate_steps": args.accumulate,
+        "evaluator": args.evaluator,
+    })
+
+    return config
+
+## the letter added to the model name for what it is trained to predict
+def _model_label(how):
+    if how == "label":
+        return "l"
+    elif how == "normal":
+        return "b"
+    elif how == "mask":
+        return "m"
+    else:
+        return "x"
+
+## Trains and evaluates a segmentation model. The script only has to provide a function that builds the model and a
+## config, the trainer owns the input pipeline, loss, metrics, step loop, checkpointing and evaluation.
+## Args: build_model - function(X, training, config) that returns the logits for the scaled input images X, resized
+##                     to [None, size, size, 1], or [None, size, size, num_classes] if output is "softmax"
+##       config - dict of settings, see DEFAULT_CONFIG. "name" is the model name, e.g. "model_s3.9.4.02"
+class Trainer(object):
+    def __init__(self, build_model, config):
+        self.build_model = build_model
+        self.config = dict(DEFAULT_CONFIG, **config)
+
+        config = self.config
+        self.model_name = config["name"] + _model_label(config["how"]) + "." + str(config["dataset"]) + str(config["version"])
+        self.action = config["action"]
+        self.batch_size = config["batch_size"]
+        self.size = config["size"]
+        self.abnormal_ratio = None
+        self.sampled_ratio = None
+
+        # the sweep only reads the stored probabilities, so it needs neither the training data nor the graph
+        if self.action == "sweep":
+            self.png_reader = None
+            return
+
+        # recomputing only saves memory in training, the exported and evaluated graphs are built without it
+        if self.action != "train":
+            config["recompute"] = False
+
+        if config["dataset"] != 100:
+            self.png_reader = None
+            self.train_files, total_records = get_training_data(what=config["dataset"])
+        elif self.action == "train":
+            # take crops_per_image random crops from each image per epoch, each image is only decoded once for them
+            self.png_reader = PngTileReader(os.path.join("data", "train_images"), self.size, scale_by=config["scale_by"],
+                                            crops_per_image=config["crops_per_image"],
+                                            positive_ratio=config["positive_ratio"])
+            total_records = self.png_reader.records_per_epoch
+        else:
+            # the other actions never read the training images, so don't start the reader's worker pool
+            self.png_reader = None
+            total_records = len(glob.glob(os.path.join("data", "train_images", "*.png"))) * config["crops_per_image"]
+
+        # the steps run a batch each, and with accumulation every accumulate_steps of them make one update, so each
+        # epoch is a whole number of updates
+        self.accumulate_steps = max(int(config["accumulate_steps"]), 1)
+        self.updates_per_epoch = max(int(total_records / self.batch_size) // self.accumulate_steps, 1)
+        self.steps_per_epoch = self.updates_per_epoch * self.accumulate_steps
+        print("Steps per epoch:", self.steps_per_epoch)
+
+        if self.accumulate_steps > 1:
+            print("Effective batch size:", self.batch_size * self.accumulate_steps)
+
+        print("Image crop size:", self.size)
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self._build_graph()
+
+        print("Graph created...")
+
+    # the training batches, either random crops of the full size images or the tfrecords
+    def _build_inputs(self):
+        config = self.config
+
+        with tf.device('/cpu:0'):
+            if self.png_reader is not None:
+                X_def, y_def = self.png_reader.read_batches(self.batch_size, distort=False,
+                                                            standardize=config["normalize"])
+            else:
+                # the class mix of the batches, changed each epoch if it is annealed
+                if config["abnormal_ratio"] is not None:
+                    self.abnormal_ratio = abnormal_ratio_variable(config["abnormal_ratio"])
+
+                X_def, y_def = read_and_decode_dataset(self.train_files, self.batch_size, label_type=config["how"],
+                                                       normalize=False, distort=False, size=config["record_size"],
+                                                       cache_dir=config["cache_dir"], abnormal_ratio=self.abnormal_ratio,
+                                                       stats=True)
+
+            # the class mix that was actually sampled, to check it follows the abnormal ratio
+            self.sampled_ratio = abnormal_fraction(y_def)
+            tf.summary.scalar('abnormal_fraction', self.sampled_ratio, collections=["summaries"])
+
+            if config["distort"]:
+                X_def, y_def = augment(X_def, y_def, horizontal_flip=True, augment_labels=True, vertical_flip=True,
+                                       mixup=0, rotate=config["rotate"], max_rotation=config["max_rotation"])
+
+        return X_def, y_def
+
+    # x-entropy with the positive pixels weighted by weight to improve recall
+    def _xe_loss(self, logits):
+        weights = tf.multiply(tf.cast(self.config["weight"] - 1, tf.float32), tf.cast(tf.greater(self.y_adj, 0), tf.float32)) + 1
+
+        if self.config["output"] == "softmax":
+            return tf.reduce_mean(tf.losses.sparse_softmax_cross_entropy(labels=self.y_adj[..., 0],
+                                                                         logits=(logits + 1e-10),
+                                                                         weights=weights[..., 0]))
+
+        return tf.reduce_mean(tf.losses.sigmoid_cross_entropy(multi_class_labels=self.y_adj, logits=self.logits_sm,
+                                                              weights=weights))
+
+    # the loss - x-entropy if loss is "xe", otherwise iou loss unless xe_loss is set in which case it is half iou and
+    # half x-entropy
+    def _build_loss(self, logits):
+        if self.config["loss"] == "xe":
+            print("Using x-entropy loss...")
+            return self._xe_loss(logits)
+
+        # flatten the logits and labels
+        logits_fl = tf.reshape(self.logits_sm, [-1])
+        labels_fl = tf.reshape(tf.cast(self.y_adj, tf.float32), [-1])
+
+        # get the intersection of the logits and labels
+        inter_mat = tf.multiply(logits_fl, labels_fl)
+
+        # reduce the sum for the intersection
+        inter = tf.reduce_sum(inter_mat)
+
+        # union is sum - intersection
+        union = tf.reduce_sum(tf.subtract(tf.add(logits_fl, labels_fl), inter_mat))
+
+        # subtract from 1 so we can minimize
+        iou_loss = tf.subtract(tf.constant(1.0, dtype=tf.float32), tf.divide(inter, union))
+
+        if not self.config["xe_loss"]:
+            print("Using IOU loss...")
+            return iou_loss
+
+        # add iou and xe loss together
+        return 0.5 * self._xe_loss(logits) + 0.5 * iou_loss
+
+    # The pixel and image metrics, accumulated as confusion counts at every threshold by a single update op in
+    # 'metrics_ops'. The scalar metrics are read out at the decision threshold, the pr curves cover all of them.
+    def _build_metrics(self):
+        config = self.config
+        size = self.size
+
+        # an image is positive if more than this many pixels are, so images with only a few positive pixels are ignored
+        pixel_counts, image_counts, _ = streaming_confusion(self.y_adj, self.logits_sm,
+                                                            num_thresholds=config["metric_thresholds"],
+                                                            min_pixels=size * size // 750,
+                                                            updates_collections=[tf.GraphKeys.UPDATE_OPS, 'metrics_ops'])
+
+        index = threshold_index(config["threshold"], config["metric_thresholds"])
+        pixel_metrics = confusion_metrics(pixel_counts)
+        image_metrics = confusion_metrics(image_counts)
+
+        self.accuracy = pixel_metrics["accuracy"][index]
+        self.recall = pixel_metrics["recall"][index]
+        self.precision = pixel_metrics["precision"][index]
+        self.iou_score = pixel_metrics["iou"][index]
+
+        tf.summary.scalar('recall_1', self.recall, collections=["summaries"])
+        tf.summary.scalar('recall_per_image', image_metrics["recall"][index], collections=["summaries"])
+        tf.summary.scalar('precision_1', self.precision, collections=["summaries"])
+        tf.summary.scalar('precision_per_image', image_metrics["precision"][index], collections=["summaries"])
+        tf.summary.scalar('f1_score', pixel_metrics["f1"][index], collections=["summaries"])
+        tf.summary.scalar('iou_score', self.iou_score, collections=["summaries"])
+        tf.summary.scalar('accuracy', self.accuracy, collections=["summaries"])
+        tf.summary.scalar('accuracy_per_image', image_metrics["accuracy"][index], collections=["summaries"])
+
+        pr_curve_summary('pr_curve', pixel_counts, collections=["summaries"])
+        pr_curve_summary('pr_curve_per_image', image_counts, collections=["summaries"])
+
+    # A training step and the op that applies the accumulated gradients after every accumulate_steps of them, which is
+    # None when the step updates the variables itself
+    def _train_op(self, optimizer, var_list=None):
+        if self.accumulate_steps == 1:
+            return optimizer.minimize(self.loss, global_step=self.global_step, var_list=var_list), None
+
+        accumulator = GradientAccumulator(optimizer, self.loss, self.accumulate_steps, global_step=self.global_step,
+                                          var_list=var_list)
+
+        return accumulator.accumulate_op, accumulator.apply_op
+
+    # the training op, which only trains the variables in the freeze scopes if freeze is set. Only the op the training
+    # loop runs is built, so there is only one set of gradient sums when accumulating.
+    def _build_train_op(self):
+        config = self.config
+
+        # Adam optimizer
+        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+
+        var_list = None
+        if config["freeze"]:
+            print("Freezing some variables...")
+            var_list = []
+            for scope in config["freeze_scopes"]:
+                var_list += tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope)
+
+        self.train_op, self.apply_op = self._train_op(optimizer, var_list=var_list)
+
+    def _build_graph(self):
+        config = self.config
+        size = self.size
+
+        # when exporting training is a constant so the dropout and batch norm training branches are never built
+        if self.action == "export":
+            self.training = tf.constant(False, dtype=tf.bool, name="is_training")
+        else:
+            self.training = tf.placeholder(dtype=tf.bool, name="is_training")
+
+        # create global step for decaying learning rate
+        self.global_step = tf.Variable(0, trainable=False)
+
+        # if we are retraining some layers start with smaller learning rate
+        if not config["stop"] and not config["freeze"]:
+            starting_rate = config["starting_rate"]
+        else:
+            starting_rate = config["retrain_rate"]
+
+        # the global step counts updates, so decay by the updates per epoch rather than the steps
+        self.learning_rate = tf.train.exponential_decay(starting_rate,
+                                                        self.global_step,
+                                                        self.updates_per_epoch * config["epochs_per_decay"],
+                                                        config["decay_factor"],
+                                                        staircase=config["staircase"])
+
+        with tf.name_scope('inputs') as scope:
+            # only training reads batches from an input pipeline, the other actions feed the images directly
+            if self.action != "train":
+                self.X = tf.placeholder(dtype=tf.float32, shape=[None, size, size, 1], name="X")
+                self.y = tf.placeholder(dtype=tf.int32, shape=[None, size, size, 1], name="y")
+            else:
+                X_def, y_def = self._build_inputs()
+
+                # Placeholders
+                self.X = tf.placeholder_with_default(X_def, shape=[None, size, size, 1], name="X")
+                self.y = tf.placeholder_with_default(y_def, shape=[None, size, size, 1], name="y")
+
+            X_adj = tf.cast(self.X, tf.float32)
+            self.y_adj = tf.cast(self.y, tf.int32)
+
+        logits = self.build_model(X_adj, self.training, config)
+
+        # the probability of the mask, the sigmoid of the logits or channel 1 of their softmax
+        if config["output"] == "softmax":
+            self.logits_sm = tf.identity(tf.nn.softmax(logits)[..., 1:2], name="logits_sm")
+        else:
+            self.logits_sm = tf.sigmoid(logits, name="logits_sm")
+
+        self.mean_ce = self._build_loss(logits)
+
+        # Add in l2 loss
+        self.loss = self.mean_ce + tf.losses.get_regularization_loss()
+
+        self._build_train_op()
+        self._build_metrics()
+
+        tf.summary.scalar('cross_entropy', self.mean_ce, collections=["summaries"])
+        tf.summary.scalar('learning_rate', self.learning_rate, collections=["summaries"])
+
+        # add this so that the batch norm gets run
+        self.extra_update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+
+        # the most memory the gpu has had in use, to compare training with and without --recompute
+        self.peak_memory = tf.contrib.memory_stats.MaxBytesInUse()
+
+        # collect the metrics ops into one op so we can run that at test time
+        self.metrics_op = tf.get_collection('metrics_ops')
+
+        # Merge all the summaries
+        self.merged = tf.summary.merge_all("summaries")
+
+        self.saver = tf.train.Saver()
+
+    # the checkpoint to start from, or None if the model is new
+    # the name of the model to load and its checkpoint, or None if it has none
+    def _checkpoint_to_load(self):
+        for name in (self.config["init_model"], self.config["restore_model"]):
+            if name is not None:
+                return name, latest_checkpoint(name)
+
+        return self.model_name, latest_checkpoint(self.model_name)
+
+    # Initialize the variables, or restore them from a checkpoint. Only a new model being trained starts from random
+    # weights, testing, exporting or predicting with a model that has no checkpoint is an error, as is initializing
+    # from or restoring a model that has none.
+    def _initialize(self, sess):
+        sess.run(tf.local_variables_initializer())
+        name, checkpoint = self._checkpoint_to_load()
+
+        if checkpoint is None and (self.action != "train" or name != self.model_name):
+            raise IOError("No checkpoint found for model " + name + " in " + os.path.join("model", name + ".ckpt"))
+
+        if checkpoint is None:
+            sess.run(tf.global_variables_initializer())
+            print("Initializing model...")
+
+        # if we are initializing with the weights from another model load it
+        elif self.config["init_model"] is not None:
+            sess.run(tf.global_variables_initializer())
+
+            # create the initializer function to initialize the weights
+            init_fn = load_weights(self.config["init_model"], exclude=self.config["init_exclude"])
+            init_fn(sess)
+
+            # reset the global step
+            sess.run(self.global_step.assign(0))
+
+            print("Initializing weights from model", self.config["init_model"])
+
+        elif self.config["restore_model"] is not None:
+            self.saver.restore(sess, checkpoint)
+            print("Restoring model from", checkpoint)
+
+        # otherwise load this model
+        else:
+            self.saver.restore(sess, checkpoint)
+            print("Restoring model", checkpoint)
+
+        # start the input pipeline
+        sess.run(tf.get_collection('iterator_initializers'))
+
+    # Run the metrics over a set of pre-cropped images. If a ProbabilityWriter is passed the probabilities are stored
+    # in the same pass.
+    # Returns: the merged summary and a dict of the metrics
+    def evaluate(self, sess, data, writer=None):
+        # reset the local variables so we have metrics only on the evaluation
+        sess.run(tf.local_variables_initializer())
+
+        for X_batch, y_batch in data.get_batches(self.batch_size):
+            feed_dict = {self.X: X_batch, self.y: y_batch, self.training: False}
+
+            if writer is None:
+                sess.run(self.metrics_op, feed_dict=feed_dict)
+            else:
+                _, probabilities = sess.run([self.metrics_op, self.logits_sm], feed_dict=feed_dict)
+                writer.add(probabilities[..., 0], y_batch[..., 0])
+
+        # one more step to get our metrics
+        summary, accuracy, recall, precision, iou = sess.run(
+            [self.merged, self.accuracy, self.recall, self.precision, self.iou_score],
+            feed_dict={self.training: False})
+
+        return summary, {"accuracy": accuracy, "recall": recall, "precision": precision, "iou": iou}
+
+    def train(self, sess):
+        config = self.config
+
+        if config["log_to_tensorboard"]:
+            train_writer = tf.summary.FileWriter('./logs/tr_' + self.model_name, sess.graph)
+            test_writer = tf.summary.FileWriter('./logs/te_' + self.model_name)
+        else:
+            train_writer = None
+
+        # validate in a separate process that watches for new checkpoints, or in the training loop
+        if config["evaluator"] is not None:
+            evaluator = self._start_evaluator()
+        else:
+            evaluator = None
+
+            # memory map the validation data once, it is cropped and scaled one batch at a time
+            cv_data = open_validation_data(how=config["how"], which=config["dataset"], scale=True, size=self.size)
+
+        # the train op only trains the unfrozen layers if we are freezing some
+        steps_per_epoch = self.steps_per_epoch
+        train_op, apply_op = self.train_op, self.apply_op
+
+        # checkpoints are written in the background while training carries on
+        checkpointer = AsyncCheckpointer(self.model_name, keep=config["keep_checkpoints"])
+
+        # log the metrics of each epoch, a restarted model carries on where its log left off
+        metrics_log = MetricsLog(self.model_name)
+
+        # trace a few steps on a schedule, the rest run untraced
+        tracer = StepTracer(self.model_name, schedule=config["trace_schedule"], epochs=config["epochs"],
+                            writer=train_writer)
+
+        # split the step time into waiting for input and compute on a sample of the steps
+        monitor = InputMonitor(sample_every=config["monitor_every"], writer=train_writer)
+
+        print("Training model", self.model_name, "...")
+
+        for epoch in range(config["epochs"]):
+            sess.run(tf.local_variables_initializer())
+
+            if self.abnormal_ratio is not None:
+                ratio = annealed_ratio(epoch, config["epochs"], config["abnormal_ratio"], config["abnormal_ratio_end"])
+                self.abnormal_ratio.load(ratio, sess)
+
+            # Accuracy values (train) after each batch, and the fraction of each batch that was abnormal
+            batch_acc = []
+            batch_abnormal = []
+
+            for i in range(steps_per_epoch):
+                # only trace the steps in the trace schedule, or lightly trace a sample for the input monitor
+                trace_options = tracer.run_options(epoch, i) or monitor.run_options(i)
+                start_time = time.time()
+
+                # Run training op and update ops
+                if (i % 50 != 0) or (i == 0):
+                    _, _, step = sess.run([train_op, self.extra_update_ops, self.global_step],
+                                          feed_dict={self.training: True},
+                                          **trace_options)
+
+                # every 50th step get the metrics
+                else:
+                    _, _, summary, acc_value, abnormal_value, step = sess.run(
+                        [train_op, self.extra_update_ops, self.merged, self.accuracy, self.sampled_ratio,
+                         self.global_step],
+                        feed_dict={self.training: True},
+                        **trace_options)
+
+                    batch_acc.append(acc_value)
+                    batch_abnormal.append(abnormal_value)
+
+                    # log the summaries to tensorboard every 50 steps
+                    if train_writer is not None:
+                        train_writer.add_summary(summary, step)
+
+                # update the variables with the gradients accumulated over the last accumulate_steps batches
+                if apply_op is not None and (i + 1) % self.accumulate_steps == 0:
+                    sess.run(apply_op)
+                    step = sess.run(self.global_step)
+
+                monitor.record(sess, time.time() - start_time, trace_options.get("run_metadata"), step)
+
+                # write the trace if this step was traced
+                tracer.record(epoch, i, step)
+
+            monitor.end_epoch(epoch)
+            print("Peak memory in use: {:.1f} MB (recompute: {})".format(sess.run(self.peak_memory) / 2.0 ** 20,
+                                                                         config["recompute"]))
+
+            if self.abnormal_ratio is not None:
+                print("Abnormal fraction - sampled {:.3f} (mean), target {:.3f}".format(np.mean(batch_abnormal), ratio))
+
+            # the evaluator validates the checkpoints itself
+            if evaluator is not None:
+                metrics_log.log(epoch, step, train_acc=np.mean(batch_acc), train_abnormal=np.mean(batch_abnormal))
+
+                if epoch % config["checkpoint_every"] == 0:
+                    print("Saving checkpoint")
+                    checkpointer.save(sess, step)
+
+                if epoch % config["print_every"] == 0:
+                    print('Epoch {:02d} - step {} - train acc: {:.3f} (mean)'.format(epoch, step, np.mean(batch_acc)))
+
+                continue
+
+            print("Evaluating model...")
+
+            summary, cv_metrics = self.evaluate(sess, cv_data)
+
+            if train_writer is not None:
+                test_writer.add_summary(summary, step)
+
+            print("Done evaluating...")
+
+            metrics_log.log(epoch, step, train_acc=np.mean(batch_acc), train_abnormal=np.mean(batch_abnormal),
+                            cv_acc=cv_metrics["accuracy"],
+                            cv_recall=cv_metrics["recall"], cv_precision=cv_metrics["precision"],
+                            cv_iou=cv_metrics["iou"])
+
+            # save checkpoint every nth epoch, the frozen variables are saved too since the saver has all of them
+            if epoch % config["checkpoint_every"] == 0:
+                print("Saving checkpoint")
+                checkpointer.save(sess, step, metric=cv_metrics["iou"])
+
+            # Print progress every nth epoch to keep output to reasonable amount
+            if epoch % config["print_every"] == 0:
+                print('Epoch {:02d} - step {} - cv acc: {:.4f} - cv iou: {:.4f} - train acc: {:.3f} (mean)'.format(
+                    epoch, step, cv_metrics["accuracy"], cv_metrics["iou"], np.mean(batch_acc)))
+
+        # wait for the last checkpoint to be written
+        checkpointer.close()
+        metrics_log.close()
+
+        # let the evaluator finish with the last checkpoint
+        if evaluator is not None:
+            open(self._done_path(), "w").close()
+            print("Waiting for the evaluator...")
+            evaluator.wait()
+
+    # marks that training has finished so the evaluator can stop once it has caught up
+    def _done_path(self):
+        return os.path.join("model", self.model_name + ".done")
+
+    # Run this script again with -a evaluate in a new process. The evaluator is hidden from the gpus unless it is
+    # asked to use them so it doesn't compete with training for memory.
+    def _start_evaluator(self):
+        if os.path.exists(self._done_path()):
+            os.remove(self._done_path())
+
+        env = dict(os.environ)
+        if self.config["evaluator"] == "cpu":
+            env["CUDA_VISIBLE_DEVICES"] = ""
+
+        print("Starting evaluator on the", self.config["evaluator"])
+
+        return subprocess.Popen([sys.executable] + sys.argv + ["-a", "evaluate"], env=env)
+
+    # Validate each new checkpoint as the trainer writes it, writing the same te_ summaries the training loop does and
+    # keeping the best checkpoint by iou. Stops once training has finished and the last checkpoint has been validated.
+    def watch(self, sess):
+        config = self.config
+        test_writer = tf.summary.FileWriter('./logs/te_' + self.model_name)
+        metrics_log = MetricsLog(self.model_name)
+
+        # memory map the validation data once, it is cropped and scaled one batch at a time
+        cv_data = open_validation_data(how=config["how"], which=config["dataset"], scale=True, size=self.size)
+
+        evaluated = None
+        while True:
+            checkpoint = latest_checkpoint(self.model_name)
+
+            if checkpoint is not None and checkpoint != evaluated:
+                try:
+                    self.saver.restore(sess, checkpoint)
+                except tf.errors.NotFoundError:
+                    # it was replaced while we were restoring it, try the new one
+                    continue
+
+                step = sess.run(self.global_step)
+                summary, cv_metrics = self.evaluate(sess, cv_data)
+                test_writer.add_summary(summary, step)
+                test_writer.flush()
+
+                metrics_log.log(None, step, cv_acc=cv_metrics["accuracy"], cv_recall=cv_metrics["recall"],
+                                cv_precision=cv_metrics["precision"], cv_iou=cv_metrics["iou"])
+
+                if update_best(self.model_name, checkpoint, cv_metrics["iou"]):
+                    print("New best checkpoint")
+
+                print('Step {} - cv acc: {:.4f} - cv recall: {:.4f} - cv iou: {:.4f}'.format(
+                    step, cv_metrics["accuracy"], cv_metrics["recall"], cv_metrics["iou"]))
+
+                evaluated = checkpoint
+
+            elif os.path.exists(self._done_path()):
+                break
+
+            else:
+                time.sleep(config["eval_poll_seconds"])
+
+        test_writer.close()
+        metrics_log.close()
+
+    # write the forward pass to a frozen graph for inference
+    def export(self, sess):
+        export_path = './model/' + self.model_name + '.pb'
+        export_stats = export_frozen_graph(sess, export_path, input_names=["inputs/X"], output_names=["logits_sm"])
+
+        print("Exported", self.model_name, "to", export_path)
+        print("Nodes: {} -> {}, batch norms folded: {}".format(export_stats["nodes_before"],
+                                                               export_stats["nodes_after"],
+                                                               export_stats["batch_norms_folded"]))
+
+        # check the exported graph loads and time it
+        export_sess, _, _, load_ms = load_frozen_graph(export_path, input_names=["inputs/X"],
+                                                       output_names=["logits_sm"])
+        export_sess.close()
+        print("Frozen graph loads in {:.1f} ms".format(load_ms))
+
+    # predict masks for full scans with a sliding window
+    def predict(self, sess, scan_path):
+        scan_files = sorted(glob.glob(os.path.join(scan_path, "*.png"))) if os.path.isdir(scan_path) else [scan_path]
+
+        if not os.path.exists(os.path.join("data", "predictions")):
+            os.makedirs(os.path.join("data", "predictions"))
+
+        for scan_file in scan_files:
+            scan = _decode_png(scan_file)[:, :, 0]
+
+            probability_map, stats = predict_scan(sess, self.X, self.logits_sm, scan, tile=self.size,
+                                                  overlap=self.size // 4, batch_size=self.batch_size,
+                                                  feed_dict={self.training: False})
+
+            np.save(os.path.join("data", "predictions", os.path.basename(scan_file)[:-4] + "_" + self.model_name + ".npy"),
+                    probability_map.astype(np.float16))
+
+            print("{} - {}x{} - {} of {} tiles - {:.2f} megapixels/sec".format(
+                os.path.basename(scan_file), scan.shape[0], scan.shape[1], stats["tiles_run"], stats["tiles"],
+                stats["megapixels_per_second"]))
+
+    # evaluate on the test data, storing the probabilities so other thresholds can be looked at with -a sweep
+    def test(self, sess):
+        print("Evaluating on test data")
+
+        te_data = open_validation_data(how=self.config["how"], data="test", which=self.config["dataset"], scale=True,
+                                       size=self.size)
+
+        writer = ProbabilityWriter(self.model_name, "test", len(te_data), shape=(self.size, self.size))
+        _, test_metrics = self.evaluate(sess, te_data, writer=writer)
+        writer.close()
+
+        # print the results
+        print("Mean Test Accuracy:", test_metrics["accuracy"])
+        print("Mean Test Recall:", test_metrics["recall"])
+        print("Mean Test Precision:", test_metrics["precision"])
+        print("Mean Test IOU:", test_metrics["iou"])
+
+        self.sweep("test")
+
+    # Compute the metrics at every threshold from the stored probabilities, without running the model. The sweep is
+    # saved to data/probabilities/<model>_<split>_sweep.npz
+    def sweep(self, split):
+        print_sweep(sweep_model(self.model_name, split, num_thresholds=self.config["sweep_thresholds"]))
+
+    # run the action from the config
+    def run(self):
+        # the sweep only needs the stored probabilities
+        if self.action == "sweep":
+            self.sweep("test")
+            return
+
+        with tf.Session(graph=self.graph, config=tf.ConfigProto()) as sess:
+            # the evaluator restores each checkpoint as it is written
+            if self.action == "evaluate":
+                self.watch(sess)
+
+                if self.png_reader is not None:
+                    self.png_reader.close()
+
+                return
+
+            self._initialize(sess)
+
+            if self.action == "train":
+                self.train(sess)
+
+            if self.png_reader is not None:
+                self.png_reader.close()
+
+            if self.action == "export":
+                self.export(sess)
+            elif self.action == "predict":
+                self.predict(sess, self.config["scan_path"])
+            else:
+                self.test(sess)
@@ -2,10 +2,18 @@ import numpy as np
 import os
 import wget
 import zipfile
+import glob
+import queue
+import hashlib
+import threading
+import time
 from sklearn.model_selection import train_test_split
 from sklearn.utils import shuffle
 import tensorflow as tf
 import math
+from dataset_utils import get_dataset, split_files, training_records, data_path
+from pipeline_utils import input_stats_aggregator, stage_latency
+from augmentation_utils import random_dihedral, random_affine
 
 ## open zip files
 def unzip(file, destination):
@@ -42,50 +50,90 @@ def download_file(url, name):
         print("Error downloading", url)
 
 
-## Batch generator with optional filenames parameter which will also return the filenames of the images
-## so that they can be identified
-def get_batches(X, y, batch_size, filenames=None, distort=False, shuffle=True):
-    shuffled_idx = np.arange(len(y))
+## Run a batch generator on a worker thread which keeps up to prefetch batches ready ahead of the caller, so gathering
+## the next batch overlaps with the sess.run of the current one. Errors in the generator are raised in the caller and
+## the worker stops if the caller stops early.
+def _prefetch_batches(batches, prefetch=2):
+    ready = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
 
-    # if we are shuffling shuffle the index
-    if shuffle:
-        np.random.shuffle(shuffled_idx)
+    # put an item on the queue unless the caller has stopped, returns False if it has
+    def put(item):
+        while not stop.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
 
-    i, h, w, c = X.shape
+        return False
 
-    # Enumerate indexes by steps of batch_size
-    for i in range(0, len(y), batch_size):
-        batch_idx = shuffled_idx[i:i + batch_size]
-        X_return = X[batch_idx]
+    def work():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+
+            put(None)
+        except Exception as e:
+            put(e)
+
+    worker = threading.Thread(target=work)
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            batch = ready.get()
+            if batch is None:
+                return
+
+            if isinstance(batch, Exception):
+                raise batch
+
+            yield batch
+    finally:
+        stop.set()
+
+## Gather the batches of get_batches into a ring of num_buffers preallocated image buffers with np.take
+def _gather_batches(X, y, batch_size, index, filenames, distort, num_buffers):
+    buffers = [np.empty((batch_size,) + X.shape[1:], dtype=X.dtype) for _ in range(num_buffers)]
+
+    for k, start in enumerate(range(0, len(index), batch_size)):
+        # read in file order, the order within a batch doesn't matter and this keeps reads from memmaps sequential
+        batch_idx = np.sort(index[start:start + batch_size])
+        X_batch = buffers[k % num_buffers][:len(batch_idx)]
+        np.take(X, batch_idx, axis=0, out=X_batch, mode="clip")
+        y_batch = y[batch_idx]
+
+        # flip each image left right on its own coin, and the masks with them
+        if distort:
+            flip = np.random.rand(len(batch_idx)) < 0.5
+            X_batch[flip] = X_batch[flip][:, :, ::-1]
 
-        # do random flipping of images
-        coin = np.random.binomial(1, 0.5, size=None)
-        if coin and distort:
-            X_return = X_return[..., ::-1, :]
+            if y_batch.ndim == X_batch.ndim:
+                y_batch[flip] = y_batch[flip][:, :, ::-1]
 
         if filenames is None:
-            yield X_return, y[batch_idx]
+            yield X_batch, y_batch
         else:
-            yield X_return, y[batch_idx], filenames[batch_idx]
+            yield X_batch, y_batch, filenames[batch_idx]
 
-## Code for data augmentation for images and labels take from http://ddokkddokk.tistory.com/11
-def _do_nothing(image, label):
-    return image, label
+## Batch generator with optional filenames parameter which will also return the filenames of the images
+## so that they can be identified. The batches are gathered on a worker thread up to prefetch batches ahead of the
+## caller into reused, preallocated buffers, so nothing is allocated per batch and the arrays are ready for feed_dict.
+## An image batch is only valid until the next batch is taken, the labels and filenames are new arrays.
+def get_batches(X, y, batch_size, filenames=None, distort=False, shuffle=True, prefetch=2):
+    index = np.arange(len(y))
 
-def _random_true_false():
-    prob = tf.random_uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    predicate = tf.less(prob, 0.5)
-    return predicate
+    # if we are shuffling shuffle the index
+    if shuffle:
+        np.random.shuffle(index)
 
-def _image_and_label_flip(image, label):
-    image_flip = tf.image.flip_left_right(image)
-    label_flip = tf.image.flip_left_right(label)
-    return image_flip, label_flip
+    # one buffer for the caller's batch, prefetch waiting and one being gathered
+    batches = _gather_batches(X, y, batch_size, index, filenames, distort, num_buffers=prefetch + 2)
 
-def _image_random_flip(image, label):
-    predicate = _random_true_false()
-    image_aug, label_aug = tf.cond(predicate, lambda: _image_and_label_flip(image, label), lambda: _do_nothing(image, label))
-    return image_aug, label_aug
+    return _prefetch_batches(batches, prefetch=prefetch)
 
 ## read data from tfrecords file
 def read_and_decode_single_example(filenames, label_type='label_normal', normalize=False, distort=False, num_epochs=None, size=299, scale=True):
@@ -146,86 +194,303 @@ def read_and_decode_single_example(filenames, label_type='label_normal', normali
     return image, label
 
 
-## load the test data from files
-def load_validation_data(data="validation", how="normal", which=5, percentage=1, scale=False, shuffle_data=1, size=640):
-    if data == "validation":
-        # load the two data files
-        if which == 4:
-            X_cv = np.load(os.path.join("data", "cv4_data.npy"))
-            labels = np.load(os.path.join("data", "cv4_labels.npy"))
-        elif which == 5:
-            X_cv = np.load(os.path.join("data", "cv5_data.npy"))
-            labels = np.load(os.path.join("data", "cv5_labels.npy"))
-        elif which == 6:
-            X_cv = np.load(os.path.join("data", "cv6_data.npy"))
-            labels = np.load(os.path.join("data", "cv6_labels.npy"))
-        elif which == 8:
-            X_cv = np.load(os.path.join("data", "cv8_data.npy"))
-            labels = np.load(os.path.join("data", "cv8_labels.npy"))
-        elif which == 9:
-            X_cv = np.load(os.path.join("data", "cv9_data.npy"))
-            labels = np.load(os.path.join("data", "cv9_labels.npy"))
-        elif which == 10:
-            X_cv = np.load(os.path.join("data", "cv10_data.npy"))
-            labels = np.load(os.path.join("data", "cv10_labels.npy"))
-        elif which == 11:
-            X_cv = np.load(os.path.join("data", "cv11_data.npy"))
-            labels = np.load(os.path.join("data", "cv11_labels.npy"))
-        elif which == 12:
-            X_cv = np.load(os.path.join("data", "cv12_data.npy"))
-            labels = np.load(os.path.join("data", "cv12_labels.npy"))
-        elif which == 13:
-            X_cv = np.load(os.path.join("data", "cv13_data.npy"))
-            labels = np.load(os.path.join("data", "cv13_labels.npy"))
-        elif which == 100:
-            X_cv = np.load(os.path.join("data", "cv101_data.npy"))
-            labels = np.load(os.path.join("data", "cv101_labels.npy"))
-        else:
-            X_cv = np.load(os.path.join("data", "cv13_data.npy"))
-            labels = np.load(os.path.join("data", "cv13_labels.npy"))
-    elif data == "test":
-        if which == 4:
-            X_cv = np.load(os.path.join("data", "test4_data.npy"))
-            labels = np.load(os.path.join("data", "test4_labels.npy"))
-        elif which == 5:
-            X_cv = np.load(os.path.join("data", "test5_data.npy"))
-            labels = np.load(os.path.join("data", "test5_labels.npy"))
-        elif which == 6:
-            X_cv = np.load(os.path.join("data", "test6_data.npy"))
-            labels = np.load(os.path.join("data", "test6_labels.npy"))
-        elif which == 8:
-            X_cv = np.load(os.path.join("data", "test8_data.npy"))
-            labels = np.load(os.path.join("data", "test8_labels.npy"))
-        elif which == 9:
-            X_cv = np.load(os.path.join("data", "test9_data.npy"))
-            labels = np.load(os.path.join("data", "test9_labels.npy"))
-        elif which == 10:
-            X_cv = np.load(os.path.join("data", "test10_data.npy"))
-            labels = np.load(os.path.join("data", "test10_labels.npy"))
-        elif which == 11:
-            X_cv = np.load(os.path.join("data", "test11_data.npy"))
-            labels = np.load(os.path.join("data", "test11_labels.npy"))
-        elif which == 12:
-            X_cv = np.load(os.path.join("data", "test12_data.npy"))
-            labels = np.load(os.path.join("data", "test12_labels.npy"))
-        elif which == 13:
-            X_cv = np.load(os.path.join("data", "test13_data.npy"))
-            labels = np.load(os.path.join("data", "test13_labels.npy"))
-        elif which == 100:
-            X_cv = np.load(os.path.join("data", "test101_data.npy"))
-            labels = np.load(os.path.join("data", "test101_labels.npy"))
+## Parse a batch of serialized examples with a single parse_example. decode_raw on the vector of image strings gives
+## one contiguous [N, H * W] uint8 tensor which is only reshaped, so there is no per-image decode or copy. Masks are
+## left as uint8 so they take a quarter of the space in the shuffle buffer, _finish_batch casts them.
+def _parse_examples(serialized, label_type='label_normal', size=299):
+    if label_type != 'label_mask':
+        features = tf.parse_example(
+            serialized,
+            features={
+                'label': tf.FixedLenFeature([], tf.int64),
+                'label_normal': tf.FixedLenFeature([], tf.int64),
+                'image': tf.FixedLenFeature([], tf.string)
+            })
+
+        # extract the data
+        label = features[label_type]
+        image = tf.decode_raw(features['image'], tf.uint8)
+
+        # reshape the images
+        image = tf.reshape(image, [-1, 299, 299, 1])
+
+    else:
+        features = tf.parse_example(
+            serialized,
+            features={
+                'label': tf.FixedLenFeature([], tf.string),
+                'image': tf.FixedLenFeature([], tf.string)
+            })
+
+        label = tf.decode_raw(features['label'], tf.uint8)
+        image = tf.decode_raw(features['image'], tf.uint8)
+
+        image = tf.reshape(image, [-1, size, size, 1])
+        label = tf.reshape(label, [-1, size, size, 1])
+
+    return image, label
+
+## the per batch processing shared by the input pipelines - cast the masks, flip, scale and normalize the images
+def _finish_batch(image, label, label_type='label_normal', normalize=False, distort=False, scale=True, mu=127.0, scale_by=255.0):
+    if label_type == 'label_mask':
+        label = tf.cast(label, tf.int32)
+
+    # random flipping of images
+    elif distort:
+        image, _ = random_dihedral(image)
+
+    if scale:
+        image = _scale_input_data(image, contrast=0, mu=mu, scale=scale_by)
+
+    if normalize:
+        image = tf.map_fn(tf.image.per_image_standardization, image)
+
+    return image, label
+
+## Get the path to cache the decoded tiles for a set of tfrecords files in. The key includes the shards' sizes and
+## modification times along with the crop size and scaling so a cache is never reused for different data. suffixes are
+## the suffixes of the cache files that are written at the path, e.g. one per class for the stratified tiles.
+def _tile_cache_path(cache_dir, filenames, label_type, size, mu, scale_by, suffixes=("",), stale_after=24 * 60 * 60):
+    key = [label_type, str(size), str(mu), str(scale_by)]
+    for filename in filenames:
+        stat = os.stat(filename)
+        key += [os.path.basename(filename), str(stat.st_size), str(int(stat.st_mtime))]
+
+    cache_path = os.path.join(cache_dir, "tiles_" + hashlib.sha1("_".join(key).encode("utf-8")).hexdigest()[:16])
+
+    # A run that was killed during the first epoch leaves a lock file but no index. A missing index also means another
+    # run is writing the cache right now though, so only remove lock files older than stale_after seconds, longer than
+    # a first epoch takes, for the cache to be rebuilt. Until then this run fails to write the cache rather than two
+    # runs writing the same one.
+    for suffix in suffixes:
+        # a finished cache file has an index, the lock files of a cache file are named <path>_<shard>.lockfile
+        if os.path.exists(cache_path + suffix + ".index"):
+            continue
+
+        for lockfile in glob.glob(cache_path + suffix + "_*.lockfile"):
+            try:
+                if time.time() - os.path.getmtime(lockfile) > stale_after:
+                    os.remove(lockfile)
+            except OSError:
+                # the writer finished or another run removed it meanwhile
+                pass
+
+    return cache_path
+
+## Read the tfrecords files as a stream of parsed tiles. The records are parsed a batch at a time with one op and split
+## back into tiles so they can be filtered, cached or shuffled individually.
+def _read_tiles(files, num_files, label_type, size, batch_size, num_parallel_calls, sloppy=True):
+    dataset = files.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset, cycle_length=num_files,
+                                                              sloppy=sloppy))
+
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.map(lambda serialized: _parse_examples(serialized, label_type=label_type, size=size),
+                          num_parallel_calls=num_parallel_calls)
+
+    return dataset.apply(tf.contrib.data.unbatch())
+
+## whether an example is abnormal, i.e. has a non zero label or any positive pixel in its mask
+def _is_abnormal(label):
+    return tf.greater(tf.reduce_max(tf.reshape(label, [-1])), 0)
+
+## the fraction of the examples in a batch of labels or masks that are abnormal, to check the mix sampled
+def abnormal_fraction(labels):
+    per_example = tf.reshape(labels, [tf.shape(labels)[0], -1])
+
+    return tf.reduce_mean(tf.cast(tf.greater(tf.reduce_max(per_example, axis=1), 0), tf.float32))
+
+## The variable to pass read_and_decode_dataset as abnormal_ratio so the mix can be changed between epochs with load().
+## It is a resource variable so the pipeline reads its current value for every tile, a ref variable would be read once
+## when the iterator is initialized. read_and_decode_dataset initializes it with the iterator.
+def abnormal_ratio_variable(ratio):
+    return tf.get_variable("abnormal_ratio", initializer=tf.constant(float(ratio), dtype=tf.float32), trainable=False,
+                           use_resource=True, collections=[])
+
+## The fraction of abnormal examples to sample at an epoch, annealed linearly from start_ratio at the first epoch to
+## end_ratio at the last, e.g. from balanced batches towards the natural mix of the data. Stays at start_ratio if
+## end_ratio is None.
+def annealed_ratio(epoch, epochs, start_ratio, end_ratio=None):
+    if end_ratio is None or epochs <= 1:
+        return start_ratio
+
+    return start_ratio + (end_ratio - start_ratio) * epoch / float(epochs - 1)
+
+## Sample a stream of tiles so that on average abnormal_ratio of them are abnormal. The tiles are split into a normal
+## and an abnormal stream, each repeated and shuffled on its own, and every tile is drawn from one of the two with
+## probability 1 - abnormal_ratio and abnormal_ratio, so no tiles are thrown away and the mix is right from the first
+## batch. tf.data doesn't share a stream between two iterators, so each class reads all the shards and keeps its own
+## tiles. With cache_path set each class is cached separately after the first pass, since two iterators can't write
+## the same cache. The ratio is read for every tile, so it can be a variable which is changed between epochs, see
+## abnormal_ratio_variable. Both classes are repeated indefinitely.
+def _stratified_tiles(tiles, abnormal_ratio, shuffle_buffer, cache_path=None):
+    classes = []
+    for name, abnormal in (("normal", False), ("abnormal", True)):
+        stream = tiles.filter(lambda image, label, abnormal=abnormal: tf.equal(_is_abnormal(label), abnormal))
+
+        if cache_path is not None:
+            stream = stream.cache(cache_path + "_" + name)
+
+        classes.append(stream.repeat().shuffle(shuffle_buffer))
+
+    # the weights of the two classes for each tile
+    def class_weights(_):
+        ratio = tf.clip_by_value(tf.cast(abnormal_ratio, tf.float32), 0.0, 1.0)
+
+        return tf.stack([1.0 - ratio, ratio])
+
+    weights = tf.data.Dataset.from_tensors(0).repeat().map(class_weights)
+
+    return tf.contrib.data.sample_from_datasets(classes, weights=weights)
+
+## Read batches from tfrecords files with tf.data instead of queue runners. The shards are read in parallel and
+## interleaved, each batch is parsed with one op and batches are prefetched so the model doesn't wait on the reader.
+## Returns the same images and labels as read_and_decode_single_example + tf.train.shuffle_batch. The iterator
+## initializer is added to the 'iterator_initializers' collection and must be run before training.
+##
+## If cache_dir is set the decoded uint8 tiles are written to a cache there during the first epoch and read back from
+## it afterwards instead of re-reading and parsing the tfrecords. Scaling is still done per batch.
+##
+## If abnormal_ratio is set the examples are sampled so that on average that fraction of each batch is abnormal,
+## instead of the natural mix of the data. It can be a float or the variable from abnormal_ratio_variable, see
+## annealed_ratio. The two classes are read as separate streams which repeat indefinitely, so num_epochs doesn't apply.
+##
+## If stats is set the latency of each stage is recorded for the InputMonitor and tensorboard.
+def read_and_decode_dataset(filenames, batch_size, label_type='label_normal', normalize=False, distort=False, num_epochs=None,
+                            size=299, scale=True, shuffle_buffer=None, num_parallel_calls=6, prefetch=2, cache_dir=None,
+                            mu=127.0, scale_by=255.0, abnormal_ratio=None, stats=False):
+    if label_type != 'label':
+        label_type = 'label_' + label_type
+
+    # bound the shuffle buffer the same way the min_after_dequeue of the shuffle queues did
+    if shuffle_buffer is None:
+        shuffle_buffer = 30 * batch_size
+
+    with tf.name_scope('input_pipeline'):
+        aggregator = input_stats_aggregator() if stats else None
+        files = tf.data.Dataset.from_tensor_slices(filenames)
+
+        if cache_dir is None:
+            cache_path = None
         else:
-            X_cv = np.load(os.path.join("data", "test13_data.npy"))
-            labels = np.load(os.path.join("data", "test13_labels.npy"))
-    elif data == "mias":
-        if which == 9:
-            X_cv = np.load(os.path.join("data", "all_mias_slices9.npy"))
-            labels = np.load(os.path.join("data", "all_mias_labels9.npy"))
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            # the stratified tiles are cached per class, see _stratified_tiles
+            suffixes = ("",) if abnormal_ratio is None else ("_normal", "_abnormal")
+            cache_path = _tile_cache_path(cache_dir, filenames, label_type, size, mu, scale_by, suffixes=suffixes)
+
+        if abnormal_ratio is not None:
+            if cache_path is None:
+                dataset = _read_tiles(files.shuffle(len(filenames)), len(filenames), label_type, size, batch_size,
+                                      num_parallel_calls)
+            else:
+                # read the shards in a fixed order so the caches are deterministic
+                dataset = _read_tiles(files, len(filenames), label_type, size, batch_size, num_parallel_calls,
+                                      sloppy=False)
+
+            # the tiles of each class are shuffled before they are mixed
+            dataset = _stratified_tiles(dataset, abnormal_ratio, shuffle_buffer, cache_path=cache_path)
+            dataset = dataset.batch(batch_size)
+
+        elif cache_dir is None:
+            files = files.shuffle(len(filenames)).repeat(num_epochs)
+
+            # read from all the shards at once
+            dataset = files.apply(tf.contrib.data.parallel_interleave(tf.data.TFRecordDataset,
+                                                                      cycle_length=len(filenames), sloppy=True))
+
+            dataset = dataset.shuffle(shuffle_buffer)
+            dataset = dataset.batch(batch_size)
+
+            # parse the whole batch at once
+            dataset = dataset.map(lambda serialized: _parse_examples(serialized, label_type=label_type, size=size),
+                                  num_parallel_calls=num_parallel_calls)
         else:
-            X_cv = np.load(os.path.join("data", "mias_test_images.npy"))
-            labels = np.load(os.path.join("data", "mias_test_labels_enc.npy"))
+            # read the shards in a fixed order so the cache is deterministic
+            dataset = _read_tiles(files, len(filenames), label_type, size, batch_size, num_parallel_calls, sloppy=False)
 
-    # encode the labels appropriately
+            dataset = dataset.cache(cache_path).repeat(num_epochs)
+
+            dataset = dataset.shuffle(shuffle_buffer)
+            dataset = dataset.batch(batch_size)
+
+        dataset = stage_latency(dataset, "read", aggregator)
+
+        # process the whole batch at once
+        dataset = dataset.map(lambda image, label: _finish_batch(image, label, label_type=label_type, normalize=normalize,
+                                                                 distort=distort, scale=scale, mu=mu, scale_by=scale_by),
+                              num_parallel_calls=num_parallel_calls)
+        dataset = stage_latency(dataset, "finish", aggregator)
+
+        dataset = dataset.prefetch(prefetch)
+        dataset = stage_latency(dataset, "prefetch", aggregator)
+
+        if aggregator is not None:
+            dataset = dataset.apply(tf.contrib.data.set_stats_aggregator(aggregator))
+
+        iterator = dataset.make_initializable_iterator()
+        initializer = iterator.initializer
+
+        # initialize the ratio variable before the pipeline that reads it
+        if isinstance(abnormal_ratio, tf.Variable):
+            with tf.control_dependencies([abnormal_ratio.initializer]):
+                initializer = tf.group(iterator.initializer)
+
+        tf.add_to_collection('iterator_initializers', initializer)
+
+        image, label = iterator.get_next()
+
+    # return the images and the labels
+    return image, label
+
+## Queue runner version of read_and_decode_single_example + tf.train.shuffle_batch for scripts that still use a
+## Coordinator. Each reader thread reads a batch of records with read_up_to and parses them with one op, the raw uint8
+## images go through the shuffle queue and are only cast and scaled after they are dequeued.
+def read_and_decode_batch(filenames, batch_size, label_type='label_normal', normalize=False, distort=False, num_epochs=None,
+                          size=299, scale=True, capacity=None, min_after_dequeue=None, num_threads=6):
+    if label_type != 'label':
+        label_type = 'label_' + label_type
+
+    if capacity is None:
+        capacity = 75 * batch_size
+
+    if min_after_dequeue is None:
+        min_after_dequeue = 30 * batch_size
+
+    filename_queue = tf.train.string_input_producer(filenames, num_epochs=num_epochs)
+
+    reader = tf.TFRecordReader()
+    _, serialized = reader.read_up_to(filename_queue, batch_size)
+
+    image, label = _parse_examples(serialized, label_type=label_type, size=size)
+
+    image, label = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=capacity,
+                                          min_after_dequeue=min_after_dequeue, num_threads=num_threads,
+                                          enqueue_many=True)
+
+    # return the processed images and labels
+    return _finish_batch(image, label, label_type=label_type, normalize=normalize, distort=distort, scale=scale)
+
+## get the paths to the files of a validation, test or mias dataset. Datasets without a split of their own fall back
+## to dataset 13 for validation and test data and to the MIAS data in dataset 0.
+def _split_files(data="validation", which=5):
+    if data not in ["validation", "test", "mias"]:
+        raise ValueError('Invalid data split!')
+
+    files = split_files(which, data)
+    if files is None:
+        files = split_files(0 if data == "mias" else 13, data)
+
+    return files
+
+## get the paths to the data and label files for a validation, test or mias dataset
+def _validation_files(data="validation", which=5):
+    files = _split_files(data=data, which=which)
+
+    return files["data"], files["labels"]
+
+## encode the labels appropriately
+def _encode_labels(labels, how="normal"):
     if how == "label":
         y_cv = labels
     elif how == "normal":
@@ -246,14 +511,33 @@ def load_validation_data(data="validation", how="normal", which=5, percentage=1,
     elif how == "mask":
         y_cv = labels.astype(np.int32)
 
-        data_size = X_cv.shape[0]
-        if data_size != size:
-            y, x = X_cv.shape[1], X_cv.shape[2]
-            startx = x // 2 - (size // 2)
-            starty = y // 2 - (size // 2)
+    return y_cv
+
+## get the slices which crop the center size x size pixels out of a batch of images
+def _center_crop_slices(shape, size):
+    y, x = shape[1], shape[2]
+    if y == size and x == size:
+        return slice(None), slice(None)
+
+    startx = x // 2 - (size // 2)
+    starty = y // 2 - (size // 2)
+
+    return slice(starty, starty + size), slice(startx, startx + size)
+
+## load the test data from files
+def load_validation_data(data="validation", how="normal", which=5, percentage=1, scale=False, shuffle_data=1, size=640):
+    data_path, labels_path = _validation_files(data=data, which=which)
+
+    X_cv = np.load(data_path)
+    labels = np.load(labels_path)
+
+    # encode the labels appropriately
+    y_cv = _encode_labels(labels, how=how)
 
-            X_cv = X_cv[:,starty:starty + size, startx:startx + size,:]
-            y_cv = y_cv[:,starty:starty + size, startx:startx + size,:]
+    if how == "mask":
+        rows, cols = _center_crop_slices(X_cv.shape, size)
+        X_cv = X_cv[:, rows, cols, :]
+        y_cv = y_cv[:, rows, cols, :]
 
     if shuffle_data:
         # shuffle the data
@@ -265,462 +549,111 @@ def load_validation_data(data="validation", how="normal", which=5, percentage=1,
 
     return X_cv, y_cv
 
+## Load the filenames of the validation or test data in the same order as load_validation_data returns the examples.
+## Splits without filenames are named by split and position in the data file, e.g. mias_12.
+def load_validation_filenames(data="validation", which=5, shuffle_data=1):
+    files = _split_files(data=data, which=which)
+    if "filenames" in files:
+        filenames = np.load(files["filenames"])
+    else:
+        num_examples = len(np.load(files["labels"], mmap_mode="r"))
+        filenames = np.array([data + "_" + str(i) for i in range(num_examples)])
+
+    # the same order sklearn's shuffle puts the data in
+    if shuffle_data:
+        index = np.arange(len(filenames))
+        np.random.RandomState(int(shuffle_data)).shuffle(index)
+        filenames = filenames[index]
+
+    return filenames
+
+## Validation or test data which is memory mapped rather than loaded. The crop, scaling and label encoding are applied
+## one batch at a time so memory use is bounded by the batch size rather than the size of the dataset.
+class MappedValidationData(object):
+    def __init__(self, data_path, labels_path, how="normal", scale=False, shuffle_data=1, size=640):
+        self.X = np.load(data_path, mmap_mode="r")
+        self.labels = np.load(labels_path, mmap_mode="r")
+        self.how = how
+        self.scale = scale
+        self.size = size
+
+        # only the masks need to be cropped
+        if how == "mask":
+            self.rows, self.cols = _center_crop_slices(self.X.shape, size)
+        else:
+            self.rows, self.cols = slice(None), slice(None)
+
+        # shuffle an index rather than the data, in the same order sklearn's shuffle would use
+        self.index = np.arange(len(self.labels))
+        if shuffle_data:
+            np.random.RandomState(int(shuffle_data)).shuffle(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    # read, crop, scale and encode the examples at the positions in idx
+    def get_batch(self, idx):
+        # read in file order so the reads from the memory map are as sequential as possible
+        idx = np.sort(idx)
+
+        X_batch = self.X[idx, self.rows, self.cols, :]
+        labels = self.labels[idx]
+
+        if self.how == "mask":
+            labels = labels[:, self.rows, self.cols, :]
+
+        y_batch = _encode_labels(labels, how=self.how)
+
+        if self.scale:
+            X_batch = X_batch.astype(np.float32)
+            X_batch -= 127.0
+            X_batch /= 255.0
+
+        return X_batch, y_batch, idx
+
+    def _batches(self, batch_size, filenames=None):
+        for i in range(0, len(self.index), batch_size):
+            X_batch, y_batch, idx = self.get_batch(self.index[i:i + batch_size])
+
+            if filenames is None:
+                yield X_batch, y_batch
+            else:
+                yield X_batch, y_batch, filenames[idx]
+
+    # Batch generator with the same interface as get_batches, the next batches are read on a worker thread
+    def get_batches(self, batch_size, filenames=None, prefetch=2):
+        return _prefetch_batches(self._batches(batch_size, filenames), prefetch=prefetch)
+
+# handles to the memory mapped data sets so each one is only opened once per run
+_mapped_data = {}
+
+## open the validation or test data as memory mapped arrays, the handle is cached so repeated calls for the same data
+## are free
+def open_validation_data(data="validation", how="normal", which=5, scale=False, shuffle_data=1, size=640):
+    data_path, labels_path = _validation_files(data=data, which=which)
+
+    key = (data_path, labels_path, how, scale, shuffle_data, size)
+    if key not in _mapped_data:
+        _mapped_data[key] = MappedValidationData(data_path, labels_path, how=how, scale=scale,
+                                                 shuffle_data=shuffle_data, size=size)
+
+    return _mapped_data[key]
+
 ## Download the data if it doesn't already exist, many datasets have been created, which one to download can be specified using
-## the what argument
+## the what argument. The files for each dataset are listed in its manifest in the datasets directory.
 def download_data(what=4):
-    if what == 8:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training8_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_0.zip',
-                              'training8_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_1.zip',
-                              'training8_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_2.zip',
-                              'training8_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_3.zip',
-                              'training8_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training8_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training8_4.zip',
-                              'training8_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test8_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_data.zip',
-                              'test8_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test8_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_filenames.npy',
-                              'test8_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test8_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test8_labels.npy',
-                              'test8_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv8_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_data.zip', 'cv8_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv8_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_labels.npy','cv8_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv8_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv8_filenames.npy',
-                              'cv8_filenames.npy')
-    elif what == 100:
-        # download and unzip images
-        if not os.path.exists(os.path.join("data", "train_images", "P_00008_LEFT_CC_10.png")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/train_images0.zip',
-                              'train_images0.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00510_RIGHT_CC_791.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images1.zip',
-                              'train_images1.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01009_RIGHT_CC_1583.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2.zip',
-                              'train_images2.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01252_RIGHT_CC_1953.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images3.zip',
-                              'train_images3.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01741_RIGHT_CC_2710.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images4.zip',
-                              'train_images4.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01501_RIGHT_CC_2343.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images5.zip',
-                              'train_images5.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00751_LEFT_CC_1184.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images6.zip',
-                              'train_images6.zip')
-
-        if not os.path.exists(os.path.join("data", "cv100_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv100_data.zip',
-                              'cv100_data.zip')
-
-        if not os.path.exists(os.path.join("data", "cv100_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv100_labels.zip',
-                              'cv100_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test100_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test100_data.zip',
-                              'test100_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test100_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test100_labels.zip',
-                              'test100_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test101_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test101_labels.zip',
-                              'test101_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "cv101_labels.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv101_labels.zip',
-                              'cv101_labels.zip')
-
-        if not os.path.exists(os.path.join("data", "test101_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/test101_data.zip',
-                              'test101_data.zip')
-
-        if not os.path.exists(os.path.join("data", "cv101_data.npy")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/cv101_data.zip',
-                              'cv101_data.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00008_RIGHT_MLO_13_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_0.zip',
-                              'train_images2_0.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_00701_LEFT_CC_844_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_1.zip',
-                              'train_images2_1.zip')
-
-        if not os.path.exists(os.path.join("data", "train_images", "P_01313_LEFT_CC_1626_cropped.png")):
-            _ = download_file('https://s3.eu-west-3.amazonaws.com/deep.skoo.ch/mammography/train_images2_2.zip',
-                              'train_images2_2.zip')
-    elif what == 9:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training9_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_0.zip',
-                              'training9_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_1.zip',
-                              'training9_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_2.zip',
-                              'training9_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_3.zip',
-                              'training9_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training9_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training9_4.zip',
-                              'training9_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test9_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_data.zip',
-                              'test9_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test9_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_filenames.npy',
-                              'test9_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test9_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test9_labels.npy',
-                              'test9_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv9_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_data.zip', 'cv9_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv9_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_labels.npy','cv9_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv9_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv9_filenames.npy',
-                              'cv9_filenames.npy')
-    elif what == 10:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training10_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_0.zip',
-                              'training10_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_1.zip',
-                              'training10_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_2.zip',
-                              'training10_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_3.zip',
-                              'training10_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training10_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training10_4.zip',
-                              'training10_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test10_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test10_data.zip',
-                              'test10_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test10_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test10_labels.npy',
-                              'test10_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv10_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv10_data.zip', 'cv10_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv10_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv10_labels.npy','cv10_labels.npy')
-    
-    elif what == 11:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training11_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_0.zip',
-                              'training11_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_1.zip',
-                              'training11_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_2.zip',
-                              'training11_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_3.zip',
-                              'training11_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training11_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training11_4.zip',
-                              'training11_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test11_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test11_data.zip',
-                              'test11_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test11_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test11_labels.zip',
-                              'test11_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv11_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv11_data.zip', 'cv11_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv11_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv11_labels.zip','cv11_labels.zip')
-
-    elif what == 12:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training12_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_0.zip',
-                              'training12_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_1.zip',
-                              'training12_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_2.zip',
-                              'training12_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_3.zip',
-                              'training12_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training12_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training12_4.zip',
-                              'training12_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test12_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test12_data.zip',
-                              'test12_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test12_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test12_labels.zip',
-                              'test12_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv12_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv12_data.zip', 'cv12_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv12_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv12_labels.zip',
-                              'cv12_labels.zip')
-            
-    elif what == 13:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training13_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_0.zip',
-                              'training13_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_1.zip',
-                              'training13_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_2.zip',
-                              'training13_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_3.zip',
-                              'training13_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training13_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training13_4.zip',
-                              'training13_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test13_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test13_data.zip',
-                              'test13_data.zip')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test13_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test13_labels.zip',
-                              'test13_labels.zip')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv13_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv13_data.zip', 'cv13_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv13_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv13_labels.zip',
-                              'cv13_labels.zip')
-    elif what == 0:
-        # download MIAS test data
-        if not os.path.exists(os.path.join("data", "mias_test_images.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_slices.npy',
-                              'mias_test_images.npy')
-
-        if not os.path.exists(os.path.join("data", "mias_test_labels_enc.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_labels.npy',
-                              'mias_test_labels_enc.npy')
-
-        # download MIAS test data
-        if not os.path.exists(os.path.join("data", "all_mias_slices9.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_slices9.npy',
-                              'all_mias_slices9.npy')
-
-        if not os.path.exists(os.path.join("data", "all_mias_labels9.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/all_mias_labels9.npy',
-                              'all_mias_labels9.npy')
-
-    elif what ==6:
-        # download and unzip tfrecords training data
-        if not os.path.exists(os.path.join("data", "training6_0.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_0.zip',
-                              'training6_0.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_1.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_1.zip',
-                              'training6_1.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_2.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_2.zip',
-                              'training6_2.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_3.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_3.zip',
-                              'training6_3.zip')
-
-        if not os.path.exists(os.path.join("data", "training6_4.tfrecords")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/training6_4.zip',
-                              'training6_4.zip')
-
-        # download and unzip test data
-        if not os.path.exists(os.path.join("data", "test6_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_data.zip',
-                              'test6_data.zip')
-
-        if not os.path.exists(os.path.join("data", "test6_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_filenames.npy',
-                              'test6_filenames.npy')
-
-        # download test labels
-        if not os.path.exists(os.path.join("data", "test6_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/test6_labels.npy',
-                              'test6_labels.npy')
-
-        # download and unzip validation data
-        if not os.path.exists(os.path.join("data", "cv6_data.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_data.zip',
-                              'cv6_data.zip')
-
-        # download validation labels
-        if not os.path.exists(os.path.join("data", "cv6_labels.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_labels.npy',
-                              'cv6_labels.npy')
-
-        if not os.path.exists(os.path.join("data", "cv6_filenames.npy")):
-            _ = download_file('https://s3.eu-central-1.amazonaws.com/aws.skoo.ch/files/cv6_filenames.npy',
-                              'cv6_filenames.npy')
+    manifest = get_dataset(what)
+    if manifest is None:
+        return
+
+    for download in manifest["downloads"]:
+        if not os.path.exists(data_path(download["file"])):
+            _ = download_file(download["url"], download["name"])
 
 ## Load the training data and return a list of the tfrecords file and the size of the dataset
 ## Multiple data sets have been created for this project, which one to be used can be set with the type argument
 def get_training_data(what=5):
-    if what == 8:
-        train_path_10 = os.path.join("data", "training8_0.tfrecords")
-        train_path_11 = os.path.join("data", "training8_1.tfrecords")
-        train_path_12 = os.path.join("data", "training8_2.tfrecords")
-        train_path_13 = os.path.join("data", "training8_3.tfrecords")
-        train_path_14 = os.path.join("data", "training8_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 40559
-
-    elif what == 9:
-        train_path_10 = os.path.join("data", "training9_0.tfrecords")
-        train_path_11 = os.path.join("data", "training9_1.tfrecords")
-        train_path_12 = os.path.join("data", "training9_2.tfrecords")
-        train_path_13 = os.path.join("data", "training9_3.tfrecords")
-        train_path_14 = os.path.join("data", "training9_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 43739
-
-    elif what == 10:
-        train_path_10 = os.path.join("data", "training10_0.tfrecords")
-        train_path_11 = os.path.join("data", "training10_1.tfrecords")
-        train_path_12 = os.path.join("data", "training10_2.tfrecords")
-        train_path_13 = os.path.join("data", "training10_3.tfrecords")
-        train_path_14 = os.path.join("data", "training10_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 55890
-
-    elif what == 12:
-        train_path_10 = os.path.join("data", "training12_0.tfrecords")
-        train_path_11 = os.path.join("data", "training12_1.tfrecords")
-        train_path_12 = os.path.join("data", "training12_2.tfrecords")
-        train_path_13 = os.path.join("data", "training12_3.tfrecords")
-        train_path_14 = os.path.join("data", "training12_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 36755
-        
-    elif what == 13:
-        train_path_10 = os.path.join("data", "training13_0.tfrecords")
-        train_path_11 = os.path.join("data", "training13_1.tfrecords")
-        train_path_12 = os.path.join("data", "training13_2.tfrecords")
-        train_path_13 = os.path.join("data", "training13_3.tfrecords")
-        train_path_14 = os.path.join("data", "training13_4.tfrecords")
-
-        train_files = [train_path_10, train_path_11, train_path_12, train_path_13, train_path_14]
-        total_records = 13548
-    else:
-        raise ValueError('Invalid dataset!')
-
-    return train_files, total_records
+    return training_records(what)
 
 def evaluate_model():
     pass
@@ -842,55 +775,42 @@ def _scale_input_data(X, contrast=None, mu=104.1353, scale=255.0):
 
 # Function to do the data augmentation on the GPU instead of the CPU, doing it on the CPU significantly slowed down training
 # Taken from https://becominghuman.ai/data-augmentation-on-gpu-in-tensorflow-13d14ecf2b19
+## Augment a batch of images, and their labels if augment_labels is set. Flips and rotate (by multiples of 90 degrees,
+## square images only) rearrange the pixels exactly, only rotations by up to max_rotation degrees, shifts and zooms
+## are warped, with the labels interpolated by nearest neighbour. A single image is augmented as a batch of one.
 def augment(images, labels,
             horizontal_flip=False,
             vertical_flip=False,
             augment_labels=False,
-            mixup=0):  # Mixup coeffecient, see https://arxiv.org/abs/1710.09412.pdf
+            mixup=0,  # Mixup coeffecient, see https://arxiv.org/abs/1710.09412.pdf
+            rotate=False,
+            max_rotation=0.0,
+            max_shift=0.0,
+            max_scale=0.0):
 
     # My experiments showed that casting on GPU improves training performance
     if images.dtype != tf.float32:
         images = tf.image.convert_image_dtype(images, dtype=tf.float32)
 
+    single = images.shape.ndims == 3
+    if single:
+        images = tf.expand_dims(images, 0)
+        if augment_labels:
+            labels = tf.expand_dims(labels, 0)
+
     with tf.name_scope('augmentation'):
-        shp = tf.shape(images)
-        batch_size, height, width = shp[0], shp[1], shp[2]
-        width = tf.cast(width, tf.float32)
-        height = tf.cast(height, tf.float32)
-
-        # The list of affine transformations that our image will go under.
-        # Every element is Nx8 tensor, where N is a batch size.
-        transforms = []
-        identity = tf.constant([1, 0, 0, 0, 1, 0, 0, 0], dtype=tf.float32)
-        if horizontal_flip:
-            coin = tf.less(tf.random_uniform([batch_size], 0, 1.0), 0.5)
-            flip_transform = tf.convert_to_tensor(
-                [-1., 0., width, 0., 1., 0., 0., 0.], dtype=tf.float32)
-            transforms.append(
-                tf.where(coin,
-                         tf.tile(tf.expand_dims(flip_transform, 0), [batch_size, 1]),
-                         tf.tile(tf.expand_dims(identity, 0), [batch_size, 1])))
-
-        if vertical_flip:
-            coin = tf.less(tf.random_uniform([batch_size], 0, 1.0), 0.5)
-            flip_transform = tf.convert_to_tensor(
-                [1, 0, 0, 0, -1, height, 0, 0], dtype=tf.float32)
-            transforms.append(
-                tf.where(coin,
-                         tf.tile(tf.expand_dims(flip_transform, 0), [batch_size, 1]),
-                         tf.tile(tf.expand_dims(identity, 0), [batch_size, 1])))
-
-        if transforms:
-            images = tf.contrib.image.transform(
-                images,
-                tf.contrib.image.compose_transforms(*transforms),
-                interpolation='BILINEAR')  # or 'NEAREST'
-
-            if augment_labels:
-                labels = tf.contrib.image.transform(
-                    labels,
-                    tf.contrib.image.compose_transforms(*transforms),
-                    interpolation='BILINEAR')  # or 'NEAREST'
+        batch_size = tf.shape(images)[0]
+
+        images, augmented_labels = random_dihedral(images, labels if augment_labels else None,
+                                                   horizontal_flip=horizontal_flip, vertical_flip=vertical_flip,
+                                                   rotate=rotate)
+
+        if max_rotation or max_shift or max_scale:
+            images, augmented_labels = random_affine(images, augmented_labels, max_rotation=max_rotation,
+                                                     max_shift=max_shift, max_scale=max_scale)
+
+        if augment_labels:
+            labels = augmented_labels
 
         def cshift(values):  # Circular shift in batch dimension
             return tf.concat([values[-1:, ...], values[:-1, ...]], 0)
@@ -902,6 +822,11 @@ def augment(images, labels,
             images = ll * images + (1 - ll) * cshift(images)
             labels = lam * labels + (1 - lam) * cshift(labels)
 
+    if single:
+        images = tf.squeeze(images, [0])
+        if augment_labels:
+            labels = tf.squeeze(labels, [0])
+
     return images, labels
 
 def standardize(tensor):
@@ -983,14 +908,18 @@ def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255
     # random crop the image
     raw_image = tf.random_crop(raw_image, size=[noisy_image_size[0], noisy_image_size[0], 3])
 
+    return _finish_crop(raw_image, crop_size=crop_size, scale_by=scale_by, mu=mu, scale=scale, distort=distort,
+                        standardize=standardize)
+
+## resize a raw crop to the crop size and split it into the image and label channels
+def _finish_crop(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255.0, distort=False, standardize=False):
     # if applicable, resize the image to the destination size
     if scale_by != 1.0:
-        image_size = crop_size
-        raw_image = tf.image.resize_images(raw_image, [image_size, image_size])
+        raw_image = tf.image.resize_images(raw_image, [crop_size, crop_size])
 
     # extract the image and label from the channels and resize them for convnet
-    image = tf.reshape(raw_image[:, :, 0], [image_size, image_size, 1])
-    label = tf.reshape(raw_image[:, :, 1], [image_size, image_size, 1])
+    image = tf.reshape(raw_image[:, :, 0], [crop_size, crop_size, 1])
+    label = tf.reshape(raw_image[:, :, 1], [crop_size, crop_size, 1])
 
     # cast the label to an int
     label = tf.cast(label, dtype=tf.int32)
@@ -1004,4 +933,4 @@ def _process_images(raw_image, crop_size=640, scale_by=0.66, mu=127.0, scale=255
     if distort:
         image, label = augment(image, label, horizontal_flip=True, augment_labels=True, vertical_flip=True, mixup=0)
 
-    return image, label
\ No newline at end of file
+    return image, label